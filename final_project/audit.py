@@ -0,0 +1,331 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import shutil
+import struct
+
+from luigi import build
+import requests
+
+from .globals import *
+from .luigi_tasks import DownloadLecture, UploadLecture, UploadSlides, is_upload_verified, refresh_lecture_link
+from .scrape import get_expected_lecture_size
+from .writer import get_checksum_path, compute_checksum
+
+NUM_AUDIT_THREADS = 8
+
+# a full download smaller than this fraction of its estimated size is considered truncated
+# note: estimates from BANDWIDTH are only approximate, so this is generous
+MIN_SIZE_FRACTION = 0.9
+
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = 0x47
+# how many (evenly spaced) TS packets to check for a sync byte
+TS_SAMPLE_PACKETS = 64
+
+
+class UnverifiableError(Exception):
+    '''
+    a lecture that can't be checked (it has no checksum sidecar or size estimate, and its playlist can't be fetched)
+    '''
+
+
+def check_ts(path, size):
+    '''
+    check that a file is made of whole, aligned MPEG-TS packets
+    
+    return: a problem description or None
+    '''
+    
+    if size % TS_PACKET_SIZE != 0:
+        return 'not a whole number of TS packets'
+    
+    num_packets = size // TS_PACKET_SIZE
+    with open(path, 'rb') as f:
+        for packet_num in sample_evenly(range(num_packets), TS_SAMPLE_PACKETS):
+            f.seek(packet_num * TS_PACKET_SIZE)
+            if f.read(1)[0] != TS_SYNC_BYTE:
+                return f'TS packet {packet_num} is missing its sync byte'
+    
+    return None
+
+
+def check_mp4(path, size):
+    '''
+    walk the top level boxes of an mp4 (regular or fragmented) and check they exactly cover the file
+    
+    return: a problem description or None
+    '''
+    
+    box_types = set()
+    offset = 0
+    with open(path, 'rb') as f:
+        while offset < size:
+            f.seek(offset)
+            header = f.read(8)
+            if len(header) < 8:
+                return f'truncated box header at byte {offset}'
+            
+            box_size, box_type = struct.unpack('>I4s', header)
+            if box_size == 1:
+                # a 64 bit size follows the type
+                largesize = f.read(8)
+                if len(largesize) < 8:
+                    return f'truncated box header at byte {offset}'
+                box_size = struct.unpack('>Q', largesize)[0]
+            elif box_size == 0:
+                # the box runs to the end of the file
+                box_size = size - offset
+            
+            if box_size < 8:
+                return f'invalid box size at byte {offset}'
+            
+            box_types.add(box_type)
+            offset += box_size
+    
+    if offset != size:
+        return f'last box ends {offset - size} bytes after the end of the file (truncated)'
+    if b'mdat' not in box_types:
+        return 'no media data (mdat) box'
+    if b'moov' not in box_types and b'moof' not in box_types:
+        return 'no movie (moov / moof) box'
+    
+    return None
+
+
+def check_lecture(path, estimated_size=None, is_test_run=False, get_playlist_size=None):
+    '''
+    check a downloaded lecture against its checksum sidecar (or its playlist), its estimated size, and its container format
+    
+    get_playlist_size (function) : returns the (size, is_exact) the lecture should have (see "get_expected_lecture_size").
+                                   only called if there is no sidecar
+    
+    return: a problem description or None (raise an UnverifiableError if there is nothing to compare the size with)
+    '''
+    
+    size = os.path.getsize(path)
+    if size == 0:
+        return 'empty file'
+    
+    # the sidecar is written by the download (see DownloadLecture)
+    try:
+        with open(get_checksum_path(path), 'r') as f:
+            checksum = json.load(f)
+    except FileNotFoundError:
+        checksum = None
+    
+    if checksum is not None:
+        if checksum['size'] != size:
+            return 'size does not match the checksum sidecar ({} != {} bytes)'.format(size, checksum['size'])
+        if checksum.get('requests_done', 0) < checksum.get('requests_total', 0):
+            return 'download stopped early ({} of {} requests)'.format(checksum['requests_done'],
+                                                                      checksum['requests_total'])
+    else:
+        # downloaded before sidecars existed (old caches don't have estimates either), so compare with the playlist instead
+        # note: old stubs are often whole, aligned segments, so the container check alone would pass them
+        expected_size, is_exact = None, False
+        reason = 'there is no playlist to compare with'
+        if get_playlist_size is not None:
+            try:
+                expected_size, is_exact = get_playlist_size()
+                reason = 'its playlist has no sizes'
+            except (IOError, ValueError) as e:
+                reason = f'its playlist could not be fetched ({e})'
+        
+        if expected_size is not None:
+            if is_exact is True and size != expected_size:
+                return 'size does not match the playlist ({} != {} bytes)'.format(size, expected_size)
+            if size < MIN_SIZE_FRACTION * expected_size:
+                return 'only {:.0%} of the size of the playlist'.format(size / expected_size)
+        elif is_test_run is True or not estimated_size:
+            raise UnverifiableError('no checksum sidecar or size estimate, and ' + reason)
+    
+    # test runs only have a sample, so there is nothing more to compare against
+    if is_test_run is True:
+        return None
+    
+    if estimated_size and size < MIN_SIZE_FRACTION * estimated_size:
+        return 'only {:.0%} of the estimated size'.format(size / estimated_size)
+    
+    with open(path, 'rb') as f:
+        start = f.read(TS_PACKET_SIZE + 1)
+    
+    if len(start) > TS_PACKET_SIZE and start[0] == TS_SYNC_BYTE and start[TS_PACKET_SIZE] == TS_SYNC_BYTE:
+        return check_ts(path, size)
+    return check_mp4(path, size)
+
+
+def check_slide(path):
+    '''
+    check that a slide is a complete jpeg
+    
+    return: a problem description or None
+    '''
+    
+    size = os.path.getsize(path)
+    if size < 4:
+        return 'empty slide'
+    
+    with open(path, 'rb') as f:
+        start = f.read(2)
+        f.seek(size - 2)
+        end = f.read(2)
+    
+    # jpegs start with an SOI marker and end with an EOI marker
+    if start != b'\xff\xd8' or end != b'\xff\xd9':
+        return 'not a complete jpeg'
+    
+    return None
+
+
+def get_playlist_size(download_task):
+    '''
+    find the size a lecture should have from its (cached) link, refreshing the link once if it expired (see DownloadLecture)
+    
+    return: (size, is_exact) (see "get_expected_lecture_size")
+    '''
+    
+    try:
+        return get_expected_lecture_size(download_task.url, download_task.player, download_task.is_test_run)
+    except requests.HTTPError as e:
+        if e.response is None or e.response.status_code not in (403, 404) or len(download_task.cache_entry) == 0:
+            raise
+    
+    url = refresh_lecture_link(**download_task.cache_entry)
+    return get_expected_lecture_size(url, download_task.player, download_task.is_test_run)
+
+
+def get_download_task(task):
+    '''
+    return the task that produces the local files of a lecture / slide task
+    '''
+    
+    if isinstance(task, (UploadLecture, UploadSlides)):
+        return task.get_download_task()
+    return task
+
+
+def audit_task(task):
+    '''
+    check the local files of a single lecture / slide task
+    
+    return: a problem description or None (files that haven't been downloaded yet are not a problem)
+    '''
+    
+    download_task = get_download_task(task)
+    
+    if isinstance(download_task, DownloadLecture):
+        path = download_task.output().path
+        if not os.path.exists(path):
+            return None
+        return check_lecture(path, download_task.estimated_size, download_task.is_test_run,
+                             get_playlist_size=lambda: get_playlist_size(download_task))
+    
+    # slides
+    targets = list(download_task.output().values())
+    existing = [target for target in targets if target.exists()]
+    if len(existing) == 0:
+        return None
+    if len(existing) != len(targets):
+        return 'only {} of {} slides'.format(len(existing), len(targets))
+    
+    for target in existing:
+        problem = check_slide(target.path)
+        if problem is not None:
+            return '{}: {}'.format(os.path.basename(target.path), problem)
+    
+    return None
+
+
+def try_audit_task(task):
+    '''
+    like "audit_task", but also return why a task can't be checked
+    
+    return: a (problem, reason it is unverifiable) tuple (both are None if the task is fine)
+    '''
+    
+    try:
+        return audit_task(task), None
+    except UnverifiableError as e:
+        return None, str(e)
+
+
+def remove_broken(task):
+    '''
+    remove the local files of a broken task (so luigi runs it again)
+    
+    for upload tasks, the S3 copy is removed too if it was uploaded from the broken files
+    '''
+    
+    download_task = get_download_task(task)
+    
+    if isinstance(download_task, DownloadLecture):
+        path = download_task.output().path
+        
+        if isinstance(task, UploadLecture):
+            part_size, multipart_threshold = get_multipart_config(task.is_test_run)
+            local_checksum = compute_checksum(path, part_size, multipart_threshold)
+            head = task.get_uploaded_head()
+            if head is not None and is_upload_verified(head, local_checksum):
+                task.output().fs.remove(task.output().path)
+        
+        for file_path in (path, get_checksum_path(path)):
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+    
+    else:
+        # slides are small, so just remove all of them
+        if isinstance(task, UploadSlides):
+            for target in task.output().values():
+                if target.exists():
+                    target.fs.remove(target.path)
+        
+        folder_path = os.path.dirname(next(iter(download_task.output().values())).path)
+        shutil.rmtree(folder_path, ignore_errors=True)
+
+
+def get_task_name(task):
+    download_task = get_download_task(task)
+    name = download_task.base_file_name if isinstance(download_task, DownloadLecture) else download_task.title
+    return download_task.course_id + '/' + name
+
+
+def audit(wrapper, requeue=True, workers=1, num_threads=NUM_AUDIT_THREADS):
+    '''
+    check every lecture and slide folder of a ProcessAllLectures wrapper (concurrently) and re-run the broken ones
+    
+    requeue (bool) : if true, remove the broken files and run their (wrapper.LectureProcess / SlideProcess) tasks again
+    
+    return: a {task: problem} dict of the broken tasks
+    '''
+    
+    # the audit is based on the cached course data, so it has to exist already
+    for master_URL, target in wrapper.input().items():
+        if not target.exists():
+            raise FileNotFoundError(f'there is no cached data for {master_URL}. download the course before auditing it')
+    
+    tasks = wrapper.get_tasks()
+    
+    with ThreadPoolExecutor(max_workers=num_threads) as pool:
+        results = list(pool.map(try_audit_task, tasks))
+    
+    task_to_problem = {task: problem for task, (problem, _) in zip(tasks, results) if problem is not None}
+    # note: unverifiable lectures aren't re-run (they might be fine), they are only reported
+    task_to_unverifiable = {task: reason for task, (_, reason) in zip(tasks, results) if reason is not None}
+    
+    print('INFO: audited {} lectures / slide folders, {} are broken, {} can not be verified'.format(
+        len(tasks), len(task_to_problem), len(task_to_unverifiable)))
+    for task, problem in task_to_problem.items():
+        print('    {}: {}'.format(get_task_name(task), problem))
+    for task, reason in task_to_unverifiable.items():
+        print('    {}: can not be verified, {}'.format(get_task_name(task), reason))
+    
+    if requeue is True and len(task_to_problem) != 0:
+        with ThreadPoolExecutor(max_workers=num_threads) as pool:
+            list(pool.map(remove_broken, task_to_problem))
+        
+        build(list(task_to_problem), local_scheduler=True, workers=workers)
+    
+    return task_to_problem
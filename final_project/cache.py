@@ -0,0 +1,72 @@
+import gzip
+import hashlib
+import pickle
+
+
+# a course cache is a small index plus one compressed page source per lecture:
+#     <course>/index.pkl.gz      : {'player_type', 'title_to_lecture': {title: {'key', 'best_m3u8s', 'lecture_infos',
+#                                                                               'lecture_url', 'm3u8s'}}}
+#     <course>/<key>.html.gz     : the page source of a single lecture (only needed for its slides)
+# the page sources are most of the data, so building tasks only has to read the index
+INDEX_FILE_NAME = 'index.pkl.gz'
+PAGE_SOURCE_EXTENSION = '.html.gz'
+
+
+def get_lecture_key(title):
+    '''
+    return a short, file name safe key for a lecture title (titles are unique within a course)
+    '''
+    
+    return hashlib.md5(title.encode()).hexdigest()
+
+
+def split_course_data(data):
+    '''
+    split the data of a course (from "get_all_lecture_data", or an old single pickle cache) into an index and page sources
+    
+    return: (index, {key: page_source})
+    '''
+    
+    # note: caches written before lecture info / links were recorded don't have these keys
+    title_to_lecture_info = data.get('title_to_lecture_info', {})
+    title_to_lecture_url = data.get('title_to_lecture_url', {})
+    title_to_m3u8s = data.get('title_to_m3u8s', {})
+    
+    title_to_lecture = {}
+    key_to_page_source = {}
+    for title, best_m3u8s in data['title_to_best_m3u8'].items():
+        key = get_lecture_key(title)
+        
+        title_to_lecture[title] = {'key': key,
+                                   'best_m3u8s': best_m3u8s,
+                                   'lecture_infos': title_to_lecture_info.get(title, []),
+                                   'lecture_url': title_to_lecture_url.get(title),
+                                   'm3u8s': title_to_m3u8s.get(title, [])}
+        
+        if title in data['title_to_page_source']:
+            key_to_page_source[key] = data['title_to_page_source'][title]
+    
+    index = {'player_type': data['player_type'], 'title_to_lecture': title_to_lecture}
+    
+    return index, key_to_page_source
+
+
+def write_index(target, index):
+    with target.open('w') as f:
+        f.write(gzip.compress(pickle.dumps(index)))
+
+
+def read_index(target):
+    # note: read the whole file first because files on S3 can't be unpickled directly
+    with target.open('r') as f:
+        return pickle.loads(gzip.decompress(f.read()))
+
+
+def write_page_source(target, page_source):
+    with target.open('w') as f:
+        f.write(gzip.compress(page_source.encode()))
+
+
+def read_page_source(target):
+    with target.open('r') as f:
+        return gzip.decompress(f.read()).decode()
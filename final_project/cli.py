@@ -1,37 +1,180 @@
 import argparse
 import os
+import sys
 from luigi.contrib.s3 import S3Client, FileNotFoundException
 
-from .luigi_tasks import DownloadAllLectures, UploadAllLectures
+from .luigi_tasks import DownloadAllLectures, UploadAllLectures, RunProgress
+from .audit import audit
+from .profiling import enable_tracing, save_trace, PROFILE_PATH
 from luigi import build
+import luigi
 
 
 parser = argparse.ArgumentParser(allow_abbrev=False)
-parser.add_argument('command', choices=['download', 'upload'], help='action to take')
-parser.add_argument('target_url', help='Canvas URL to download from')
+parser.add_argument('command', choices=['download', 'upload', 'audit'], help='action to take')
+parser.add_argument('target_urls', nargs='*', help='Canvas URL(s) to download from')
+parser.add_argument('--url_file', help='a file listing Canvas URLs to download from (one per line)')
 parser.add_argument('--full', help='do a full run (not a just a test run)', action='store_true')
 parser.add_argument('--process_slides', help='download slides (only effects Panopto player)', action='store_true')
+parser.add_argument('--workers', help='number of worker processes to run on this machine', type=int, default=1)
+parser.add_argument('--scheduler_host', help='run against a central luigid scheduler on this host (distributed mode)')
+parser.add_argument('--scheduler_port', help='port of the central luigid scheduler', type=int, default=8082)
+parser.add_argument('--shard', help='only process shard I of N of the lectures/slides ("I/N", zero based)')
+parser.add_argument('--disk_budget', help='upload only: keep at most about this many GB of lectures on disk at once', type=float)
+parser.add_argument('--requeue', help='what to re-run for broken lectures/slides found by an audit', choices=['none', 'download', 'upload'],
+                    default='download')
+parser.add_argument('--profile', help='write a (Chrome trace-event) timing trace of the discovery stages', action='store_true')
+parser.add_argument('--cprofile', help='like --profile, but also dump cProfile stats of the CPU heavy stages', action='store_true')
+
+
+def get_target_urls(args):
+    '''
+    collect the target urls from the command line and the (optional) url file, dropping duplicates
+    '''
+    
+    target_urls = list(args.target_urls)
+    
+    if args.url_file is not None:
+        with open(args.url_file, 'r') as url_file:
+            for line in url_file:
+                line = line.strip()
+                # skip blank lines and comments
+                if line != '' and not line.startswith('#'):
+                    target_urls.append(line)
+    
+    # keep the order the user gave us
+    target_urls = list(dict.fromkeys(target_urls))
+    
+    if len(target_urls) == 0:
+        parser.error('you must give at least one target_url (or a --url_file)')
+    
+    return target_urls
+
+
+def get_shard(args):
+    '''
+    parse the "I/N" --shard argument into a (shard_index, num_shards) tuple
+    '''
+    
+    if args.shard is None:
+        return 0, 1
+    
+    try:
+        shard_index, num_shards = (int(x) for x in args.shard.split('/'))
+    except ValueError:
+        parser.error(f'--shard must look like "I/N" (got "{args.shard}")')
+    
+    if not 0 <= shard_index < num_shards:
+        parser.error(f'--shard index must be between 0 and {num_shards - 1} (got {shard_index})')
+    
+    return shard_index, num_shards
+
+
+def get_disk_budget(args):
+    '''
+    convert the --disk_budget argument (in GB) to bytes (or None if there is no budget)
+    '''
+    
+    if args.disk_budget is None:
+        return None
+    
+    if args.command != 'upload':
+        parser.error('--disk_budget can only be used with the upload command (lectures are removed once they are uploaded)')
+    # note: luigi resources live on the scheduler, so a central scheduler would share one budget between all hosts
+    if args.scheduler_host is not None:
+        parser.error('--disk_budget can not be used with --scheduler_host')
+    if args.disk_budget <= 0:
+        parser.error(f'--disk_budget must be positive (got {args.disk_budget})')
+    
+    return int(args.disk_budget * 1024**3)
+
+
+def check_S3_ROOT():
+    '''
+    make sure the S3_ROOT pulled from the .env file exists and is viable
+    '''
+    
+    if os.getenv('S3_ROOT') is None:
+        raise KeyError('DEBUG: you must set an S3_ROOT variable')
+    else:
+        root = os.getenv('S3_ROOT')
+        if S3Client().is_dir(root) is False:
+            raise FileNotFoundException(f'S3_ROOT ({root}) is not a valid directory')
+
+
+def run_distributed(wrapper, args):
+    '''
+    run a ProcessAllLectures wrapper against a central luigid scheduler
+    
+    the scheduler makes sure that every task only runs once, no matter how many hosts/workers schedule it. so the discovery
+    happens on whichever host gets there first, and hosts started without --shard take any task that is still pending
+    '''
+    
+    scheduler_params = {'scheduler_host': args.scheduler_host, 'scheduler_port': args.scheduler_port}
+    
+    # keep waiting (instead of exiting) while other hosts run tasks we are waiting on (ex: the discovery)
+    config = luigi.configuration.get_config()
+    if not config.has_section('worker'):
+        config.add_section('worker')
+    config.set('worker', 'keep_alive', 'true')
+    
+    # publish the (shared) course cache once
+    # note: the lecture tasks are built from this cache, so there is nothing to schedule without it
+    if build([wrapper.requires()], **scheduler_params) is False:
+        sys.exit('ERROR: the course discovery failed (see the luigi log above), so there are no lectures to process')
+    
+    # schedule this host's share of the lectures / slides
+    tasks = wrapper.get_tasks()
+    # without --shard, other hosts finish some of these tasks, so there is no overall ETA
+    RunProgress(tasks, wrapper.LectureProcess, is_shared=args.shard is None)
+    build(tasks, workers=args.workers, **scheduler_params)
 
 
 def main():
     args = parser.parse_args()
-    params = {'master_URL': args.target_url,
+    shard_index, num_shards = get_shard(args)
+    
+    if args.profile is True or args.cprofile is True:
+        enable_tracing(use_cprofile=args.cprofile)
+    
+    params = {'master_URLs': get_target_urls(args),
               'process_slides': args.process_slides,
-              'is_test_run': not args.full}
-    
-    if args.command == 'download':
-        build([DownloadAllLectures(**params)], local_scheduler=True)
-    elif args.command == 'upload':
-        # if we are doing an upload, make sure the S3_ROOT pulled from the .env file exists and is viable
-        if os.getenv('S3_ROOT') is None:
-            raise KeyError('DEBUG: you must set an S3_ROOT variable')
-        else:
-            root = os.getenv('S3_ROOT')
-            if S3Client().is_dir(root) is False:
-                raise FileNotFoundException(f'S3_ROOT ({root}) is not a valid directory')
-        
-        # run the task
-        build([UploadAllLectures(**params)], local_scheduler=True)
+              'is_test_run': not args.full,
+              # in distributed mode, the course cache is shared between hosts through S3
+              'shared_cache': args.scheduler_host is not None,
+              'shard_index': shard_index,
+              'num_shards': num_shards,
+              'workers': args.workers,
+              'disk_budget': get_disk_budget(args)}
+    
+    # an audit re-uploads (and checks the S3 copies of) broken lectures if they are requeued as uploads
+    is_upload = args.command == 'upload' or (args.command == 'audit' and args.requeue == 'upload')
+    
+    # if we are doing an upload (or sharing the cache), make sure S3_ROOT is viable
+    if is_upload is True or args.scheduler_host is not None:
+        check_S3_ROOT()
+    
+    if is_upload is True:
+        wrapper = UploadAllLectures(**params)
+    else:
+        wrapper = DownloadAllLectures(**params)
+    
+    # run the task
+    if args.command == 'audit':
+        try:
+            audit(wrapper, requeue=args.requeue != 'none', workers=args.workers)
+        except FileNotFoundError as e:
+            parser.error(str(e))
+    elif args.scheduler_host is None:
+        build([wrapper], local_scheduler=True)
+    else:
+        run_distributed(wrapper, args)
+    
+    trace_path = save_trace()
+    if trace_path is not None:
+        print(f'INFO: timing trace saved to {trace_path} (open it in chrome://tracing or https://ui.perfetto.dev)')
+        if args.cprofile is True:
+            print(f'INFO: cProfile stats saved to {PROFILE_PATH}')
     
     
     print('*'*100 + '\n' + '*'*100)
@@ -11,9 +11,57 @@ else:
     if os.path.isdir(VIDEO_PATH) is False:
         raise OSError(f'VIDEO_PATH ({VIDEO_PATH}) is not a valid directory')
 
+# set the S3 multipart part size (default: 8MB, the luigi / boto3 default)
+S3_PART_SIZE = int(os.getenv('S3_PART_SIZE', 8*1048576))
+# note: boto3 bumps smaller parts up to 5MB (the S3 minimum), so the expected ETags would never match
+if S3_PART_SIZE < 5*1048576:
+    raise ValueError(f'S3_PART_SIZE ({S3_PART_SIZE}) must be at least 5MB (5242880 bytes)')
+# files smaller than this are uploaded with a single PUT (boto3 default)
+S3_MULTIPART_THRESHOLD = 8*1048576
+
+# smoke test (a.k.a. test run) settings. smoke output lives in its own 'smoke' folder (locally and on S3)
+SMOKE_DIR = 'smoke'
+SMOKE_SEGMENTS = 8          # evenly spaced playlist segments per lecture (panopto)
+SMOKE_BYTES = 16*1048576    # bytes per lecture (matterhorn)
+SMOKE_SLIDES = 2            # evenly spaced slides per lecture
+# smoke uploads always use multipart (with the smallest part size S3 allows) so that code path is tested too
+SMOKE_PART_SIZE = 5*1048576
+# note: boto3 rejects a threshold of 0, but 1 byte still makes every (non empty) upload multipart
+SMOKE_MULTIPART_THRESHOLD = 1
+
 
 def clean_file_name(file_name):
     '''
     replace all invalid filename characters
     '''
     return re.sub(r'[\\/:*?"<>|]', '_', file_name)
+
+
+def get_video_path(is_test_run=False):
+    '''
+    return the folder lectures and slides are saved to (smoke tests get their own folder)
+    '''
+    if is_test_run is True:
+        return os.path.join(VIDEO_PATH, SMOKE_DIR)
+    return VIDEO_PATH
+
+
+def get_multipart_config(is_test_run=False):
+    '''
+    return the (part_size, multipart_threshold) used to upload lectures to S3
+    '''
+    if is_test_run is True:
+        return SMOKE_PART_SIZE, SMOKE_MULTIPART_THRESHOLD
+    return S3_PART_SIZE, S3_MULTIPART_THRESHOLD
+
+
+def sample_evenly(items, num_items):
+    '''
+    deterministically pick num_items evenly spaced items from a list (always including the first and last item)
+    '''
+    if len(items) <= num_items:
+        return list(items)
+    if num_items == 1:
+        return [items[0]]
+    indices = sorted({round(i * (len(items) - 1) / (num_items - 1)) for i in range(num_items)})
+    return [items[i] for i in indices]
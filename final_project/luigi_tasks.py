@@ -1,11 +1,20 @@
-from luigi import Task, Parameter, BoolParameter, IntParameter, build
+from luigi import Task, Parameter, BoolParameter, IntParameter, FloatParameter, ListParameter, DictParameter, Event, build
 from luigi.local_target import LocalTarget
 from luigi.contrib.s3 import S3Target
 import luigi
 
+import datetime
+import hashlib
+import math
+import multiprocessing
 import os
 import pickle
 import shutil
+import time
+from urllib.parse import urlsplit
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+import requests
 
 
 from .globals import *
@@ -17,6 +26,86 @@ S3_ROOT =  os.getenv('S3_ROOT')
 
 
 from .scrape import *
+from .writer import is_md5_etag, get_checksum_path, save_checksum, load_checksum, compute_checksum
+from .cache import *
+
+
+def get_course_id(master_URL):
+    '''
+    return the (unique) class_id of a course
+    '''
+    
+    # extract unique class_id from utl
+    return master_URL.split('/')[4]
+
+
+def get_course_cache_root(master_URL, shared_cache=False):
+    '''
+    return the folder holding the cache of a single course
+    '''
+    
+    class_id = get_course_id(master_URL)
+    
+    # when running on many machines, the cache is published to S3 so the discovery only happens once
+    if shared_cache is True:
+        return S3_ROOT + '/luigi_cache/' + class_id
+    return os.path.join(CACHE_PATH, class_id)
+
+
+def get_cache_target(master_URL, file_name, shared_cache=False):
+    '''
+    return the target of a single file of a course cache (see cache.py)
+    '''
+    
+    root = get_course_cache_root(master_URL, shared_cache)
+    
+    if shared_cache is True:
+        return S3Target(root + '/' + file_name, format=luigi.format.Nop)
+    return LocalTarget(os.path.join(root, file_name), format=luigi.format.Nop)
+
+
+def save_course_data(master_URL, data, shared_cache=False):
+    '''
+    write the data of a course (from "get_all_lecture_data") to its cache
+    '''
+    
+    index, key_to_page_source = split_course_data(data)
+    
+    # the index is written last, so a course is only cached once all of its page sources are
+    for key, page_source in key_to_page_source.items():
+        write_page_source(get_cache_target(master_URL, key + PAGE_SOURCE_EXTENSION, shared_cache), page_source)
+    
+    write_index(get_cache_target(master_URL, INDEX_FILE_NAME, shared_cache), index)
+
+
+def load_old_course_data(master_URL, shared_cache=False):
+    '''
+    load the data of a course from the single pickle file courses used to be cached to
+    
+    return: the data (or None if there is no old cache)
+    '''
+    
+    root = get_course_cache_root(master_URL, shared_cache)
+    
+    if shared_cache is True:
+        target = S3Target(root + '.pkl', format=luigi.format.Nop)
+    else:
+        target = LocalTarget(root + '.pkl', format=luigi.format.Nop)
+    
+    if not target.exists():
+        return None
+    
+    with target.open('r') as cache:
+        return pickle.loads(cache.read())
+
+
+def load_page_source(master_URL, title, shared_cache=False):
+    '''
+    load the page source of a single lecture from its course cache
+    '''
+    
+    file_name = get_lecture_key(title) + PAGE_SOURCE_EXTENSION
+    return read_page_source(get_cache_target(master_URL, file_name, shared_cache))
 
 
 class SaveLectureData(Task):
@@ -25,130 +114,392 @@ class SaveLectureData(Task):
     '''
     
     master_URL = Parameter()
+    shared_cache = BoolParameter(default=False)
     
     # NOTE: nothing is "required"
 
     def output(self):
-        # extract unique class_id from utl
-        class_id = self.master_URL.split('/')[4]
-        # generate class specific cache file (meaning this task will only re-run on new courses)
-        return LocalTarget(os.path.join(CACHE_PATH, class_id + '.pkl'), format=luigi.format.Nop)
+        # generate class specific cache index (meaning this task will only re-run on new courses)
+        return get_cache_target(self.master_URL, INDEX_FILE_NAME, self.shared_cache)
     
     def run(self):
-        # do setup
-        driver = setup_and_login()
-
-        # get sources
-        player_page_source, player_type = get_player_page_source(driver, self.master_URL)
+        # convert an old cache instead of doing the discovery again
+        data = load_old_course_data(self.master_URL, self.shared_cache)
+        if data is None:
+            # do all discovery for this course
+            data = get_all_lecture_data([self.master_URL])[self.master_URL]
+        
+        save_course_data(self.master_URL, data, self.shared_cache)
 
-        # get video dict
-        lecture_to_url = extract_lecture_links(player_page_source, player=player_type)
 
-        # open all links
-        title_to_page_source = open_lecture_links(driver, lecture_to_url, player=player_type)
-        # extract data from network
-        all_lecture_m3u8s = extract_m3u8s_from_netlog()
+class SaveAllLectureData(Task):
+    '''
+    given many URLs, find video download links for every course that is not cached yet using a single login
+    '''
+    
+    master_URLs = ListParameter()
+    shared_cache = BoolParameter(default=False)
+    
+    # NOTE: nothing is "required"
+    
+    def output(self):
+        # reuse the per-course cache files so single and batch runs share a cache
+        return {master_URL: SaveLectureData(master_URL=master_URL, shared_cache=self.shared_cache).output()
+                for master_URL in self.master_URLs}
+    
+    def run(self):
+        # only crawl courses that are missing from the cache
+        missing_URLs = []
+        for master_URL, target in self.output().items():
+            if target.exists():
+                continue
+            
+            # courses with an old cache are just converted
+            data = load_old_course_data(master_URL, self.shared_cache)
+            if data is not None:
+                save_course_data(master_URL, data, self.shared_cache)
+            else:
+                missing_URLs.append(master_URL)
         
-        # organize extracted data
-        title_to_m3u8s = get_title_to_m3u8s(lecture_to_url, all_lecture_m3u8s, player=player_type)
-
-        # find final download links
-        title_to_best_m3u8 = get_title_to_download_links(title_to_m3u8s, player=player_type)
+        # every course was converted, so there is no need to log in
+        if len(missing_URLs) == 0:
+            return
         
-        # pack required data into dict
-        data = {'title_to_page_source': title_to_page_source,
-                'title_to_best_m3u8': title_to_best_m3u8,
-                'player_type': player_type}
+        master_URL_to_data = get_all_lecture_data(missing_URLs)
         
-        with self.output().open('w') as cache:
-            pickle.dump(data, cache)
+        for master_URL, data in master_URL_to_data.items():
+            save_course_data(master_URL, data, self.shared_cache)
+
+
+def refresh_lecture_link(master_URL, title, url_num, shared_cache=False):
+    '''
+    refresh the (expired) download links of a single lecture and update its course cache index in place
+    
+    return: the new download link of perspective url_num
+    '''
+    
+    target = get_cache_target(master_URL, INDEX_FILE_NAME, shared_cache)
+    index = read_index(target)
+    
+    lecture = index['title_to_lecture'][title]
+    best_m3u8s, lecture_infos = refresh_download_links(title, lecture, index['player_type'])
+    
+    # perspectives are matched by position, so a different number of them means we can't tell which camera is which
+    if len(best_m3u8s) != len(lecture['best_m3u8s']):
+        raise ValueError('"{}" has {} perspectives after refreshing its links (instead of {}). delete the course cache and '
+                         'run again'.format(title, len(best_m3u8s), len(lecture['best_m3u8s'])))
+    
+    lecture['best_m3u8s'], lecture['lecture_infos'] = best_m3u8s, lecture_infos
+    
+    # note: writes are atomic, so a concurrent refresh of another lecture can at worst undo this update (which just means
+    # this lecture gets refreshed again next time)
+    write_index(target, index)
+    
+    return lecture['best_m3u8s'][url_num]
+
+
+def get_course_path(course_id, is_test_run=False):
+    '''
+    return the folder the lectures and slides of a single course are saved to
+    
+    note: lecture titles are only unique within a course (every course has a "Lecture 1"), so every course gets its own folder
+    '''
+    
+    return os.path.join(get_video_path(is_test_run), course_id)
 
 
 #-------------------------------------------------------------------------------------------------------------------
 #-------------------------------------------------- lecture tasks --------------------------------------------------
 #-------------------------------------------------------------------------------------------------------------------
 
-class DownloadLecture(Task):
+class LectureEstimatesMixin:
+    '''
+    the estimates from SaveLectureData that every lecture task takes (only used for scheduling / progress)
+    '''
+    
+    estimated_size = IntParameter(default=None, significant=False)
+    estimated_duration = FloatParameter(default=None, significant=False)
+    
+    @property
+    def priority(self):
+        # run the biggest lectures first so all workers finish at about the same time
+        return (self.estimated_size or 0) // 1048576
+
+
+class DownloadLecture(LectureEstimatesMixin, Task):
     '''
     download a single lecture
     '''
     
+    course_id = Parameter()
     base_file_name = Parameter()
     url = Parameter()
     player = Parameter()
     timeout_max = IntParameter(default=None)
+    is_test_run = BoolParameter(default=False)
+    
+    # where url came from ({'master_URL', 'title', 'url_num', 'shared_cache'}), so an expired url can be refreshed
+    cache_entry = DictParameter(default={}, significant=False)
     
     # NOTE: nothing is "required"
     
     def output(self):
-        return LocalTarget(os.path.join(VIDEO_PATH, clean_file_name(self.base_file_name) + '.mp4'),
-                           format=luigi.format.Nop)
+        file_name = clean_file_name(self.base_file_name) + '.mp4'
+        return LocalTarget(os.path.join(get_course_path(self.course_id, self.is_test_run), file_name), format=luigi.format.Nop)
     
     def run(self):
         print('*'*25, 'started downloading lecture', '*'*25)
         
         with self.output().temporary_path() as tmp_path:
-            download_lecture(url=self.url,
-                             player=self.player,
-                             base_file_name='THIS_IS_NOT_USED_HERE',
-                             mp4_path=tmp_path,
-                             timeout_max=self.timeout_max)
+            try:
+                checksum = download_lecture(url=self.url,
+                                            player=self.player,
+                                            base_file_name='THIS_IS_NOT_USED_HERE',
+                                            mp4_path=tmp_path,
+                                            timeout_max=self.timeout_max,
+                                            is_test_run=self.is_test_run)
+            except requests.HTTPError as e:
+                # a 403 / 404 means the cached CDN link expired. refresh it (no browser needed) and try once more
+                if e.response is None or e.response.status_code not in (403, 404) or len(self.cache_entry) == 0:
+                    raise
+                
+                print('INFO: the cached link for "{}" has expired, refreshing it'.format(self.base_file_name))
+                url = refresh_lecture_link(**self.cache_entry)
+                
+                checksum = download_lecture(url=url,
+                                            player=self.player,
+                                            base_file_name='THIS_IS_NOT_USED_HERE',
+                                            mp4_path=tmp_path,
+                                            timeout_max=self.timeout_max,
+                                            is_test_run=self.is_test_run)
+            
+            # write the checksum sidecar before the mp4 is moved into place (so an mp4 always has an up to date sidecar)
+            save_checksum(self.output().path, checksum)
+
+
+def get_S3_root(is_test_run=False):
+    '''
+    return the S3 folder lectures are uploaded to (smoke tests get their own folder)
+    '''
+    
+    if is_test_run is True:
+        return S3_ROOT + '/' + SMOKE_DIR
+    return S3_ROOT
+
+
+# slides are small jpegs, this is a generous upper bound for a disk budget
+ESTIMATED_SLIDE_SIZE = 262144
+
+
+def get_disk_budget_MB(disk_budget):
+    '''
+    return the size (in MB) of the luigi "disk" resource for a disk budget (in bytes)
+    '''
+    
+    return max(1, disk_budget // 1048576)
+
+
+def get_disk_reservation(estimated_size, disk_budget):
+    '''
+    return how much of the "disk" resource (in MB) a lecture (or slide folder) reserves while it is downloaded, uploaded
+    and removed
+    '''
+    
+    # lectures without an estimate reserve the whole budget (so they run alone)
+    if estimated_size is None:
+        estimated_size = disk_budget
+    
+    # note: luigi never runs a task that needs more than the whole budget
+    return min(math.ceil(estimated_size / 1048576), get_disk_budget_MB(disk_budget))
+
+
+def upload_file(s3_client, local_path, s3_path, part_size, multipart_threshold):
+    '''
+    upload a local file to S3 (like "S3Client.put_multipart", but also choosing when multipart is used)
+    '''
+    
+    split = urlsplit(s3_path)
+    bucket, key = split.netloc, split.path.lstrip('/')
+    
+    config = TransferConfig(multipart_threshold=multipart_threshold, multipart_chunksize=part_size)
+    s3_client.s3.meta.client.upload_file(local_path, bucket, key, Config=config)
+
+
+def is_upload_verified(head, checksum):
+    '''
+    check that an uploaded object (its "head_object" response) matches a checksum sidecar
+    
+    the ETag is compared if it can be an md5 of the data. with SSE-KMS / SSE-C it can't, so only the size is compared
+    '''
+    
+    etag = head['ETag'].strip('"')
+    encryption = head.get('ServerSideEncryption') or ''
+    
+    if is_md5_etag(etag) and not encryption.startswith('aws:kms') and 'SSECustomerAlgorithm' not in head:
+        return etag == checksum['etag']
+    return head['ContentLength'] == checksum['size']
 
 
-class UploadLecture(Task):
+class UploadLecture(LectureEstimatesMixin, Task):
     '''
     upload a single lecture to S3 (will download lecture first if needed)
     '''
     
+    course_id = Parameter()
     base_file_name = Parameter()
     url = Parameter(default='')
     player = Parameter(default='')
     timeout_max = IntParameter(default=None)
+    is_test_run = BoolParameter(default=False)
     
-    def requires(self):
-        return DownloadLecture(base_file_name=self.base_file_name,
+    # where url came from (see DownloadLecture)
+    cache_entry = DictParameter(default={}, significant=False)
+    
+    # if set, only about this many bytes of lectures are on disk at once, and lectures are removed once they are uploaded
+    disk_budget = IntParameter(default=None, significant=False)
+    
+    @property
+    def resources(self):
+        # with a disk budget, the lecture's disk space is reserved from before it is downloaded until it is removed
+        if self.disk_budget is None:
+            return {}
+        return {'disk': get_disk_reservation(self.estimated_size, self.disk_budget)}
+    
+    def get_download_task(self):
+        return DownloadLecture(course_id=self.course_id,
+                               base_file_name=self.base_file_name,
                                url=self.url,
                                player=self.player,
-                               timeout_max=self.timeout_max)
+                               timeout_max=self.timeout_max,
+                               is_test_run=self.is_test_run,
+                               estimated_size=self.estimated_size,
+                               estimated_duration=self.estimated_duration,
+                               cache_entry=self.cache_entry)
+    
+    # NOTE: nothing is "required". the lecture is downloaded in run instead, so the download and the upload always happen
+    # on the same host (with a central scheduler, a required DownloadLecture could run on another host's disk) and a disk
+    # budget reservation covers both
     
     def output(self):
-        return S3Target(S3_ROOT + '/' + clean_file_name(self.base_file_name) + '.mp4', format=luigi.format.Nop)
+        # note: lectures are grouped by course (like on disk, see "get_course_path")
+        file_name = clean_file_name(self.base_file_name) + '.mp4'
+        return S3Target(get_S3_root(self.is_test_run) + '/' + self.course_id + '/' + file_name, format=luigi.format.Nop)
+    
+    def get_expected_checksum(self):
+        '''
+        return the checksum the uploaded lecture should have (from the download sidecar, computing it if needed)
+        '''
+        
+        local_path = self.get_download_task().output().path
+        part_size, multipart_threshold = get_multipart_config(self.is_test_run)
+        
+        checksum = load_checksum(local_path, part_size, multipart_threshold)
+        if checksum is None:
+            # downloaded without a (matching) sidecar, so we have to read the file once
+            checksum = compute_checksum(local_path, part_size, multipart_threshold)
+            save_checksum(local_path, checksum)
+        
+        return checksum
+    
+    def get_uploaded_head(self):
+        '''
+        return the metadata ("head_object") of the uploaded lecture (or None if it hasn't been uploaded)
+        '''
+        
+        split = urlsplit(self.output().path)
+        try:
+            return self.output().fs.s3.meta.client.head_object(Bucket=split.netloc, Key=split.path.lstrip('/'))
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
     
     def run(self):
         print('*'*25, 'started uploading lecture', '*'*25)
         
-        with self.requires().output().open('r') as inf, self.output().open('w') as outf:
-            outf.write(inf.read())
+        download_task = self.get_download_task()
+        local_path = download_task.output().path
+        
+        # download the lecture here (unless it is already on disk)
+        if not download_task.complete():
+            download_task.run()
+        
+        # upload straight from disk (S3Target.open would copy the whole file to a temp file first)
+        part_size, multipart_threshold = get_multipart_config(self.is_test_run)
+        upload_file(self.output().fs, local_path, self.output().path, part_size, multipart_threshold)
+        
+        # verify the upload by comparing metadata (no second pass over the data)
+        head = self.get_uploaded_head()
+        checksum = self.get_expected_checksum()
+        if head is None or not is_upload_verified(head, checksum):
+            if head is not None:
+                self.output().fs.remove(self.output().path)
+            raise IOError(f'upload of "{self.base_file_name}" is corrupt (it does not match its checksum sidecar)')
+        
+        # the upload is verified, so free up the disk space (later runs see the lecture is done through S3)
+        if self.disk_budget is not None:
+            for file_path in (local_path, get_checksum_path(local_path)):
+                try:
+                    os.remove(file_path)
+                except FileNotFoundError:
+                    pass
+    
+    def complete(self):
+        '''
+        the lecture is only uploaded if it exists on S3 and matches the local download
+        '''
+        
+        if super().complete() is False:
+            return False
+        
+        # nothing local to compare against (ex: it was removed after the upload), so trust S3
+        local_target = self.get_download_task().output()
+        checksum = None
+        if local_target.exists() is True:
+            checksum = load_checksum(local_target.path, *get_multipart_config(self.is_test_run))
+        if checksum is None:
+            return True
+        
+        # note: uses the same rule as run (so a lecture that was verified there is complete)
+        head = self.get_uploaded_head()
+        return head is not None and is_upload_verified(head, checksum)
 
 
 #-----------------------------------------------------------------------------------------------------------------
 #-------------------------------------------------- slide tasks --------------------------------------------------
 #-----------------------------------------------------------------------------------------------------------------
 
-class PageSourceParameter(Parameter):
-    '''
-    an "ease of use" class so the full page source isn't printed to the console
-    '''
-    def serialize(self, x):
-        return ''
-
-
 class DownloadSlides(Task):
     '''
     download slides from a single lecture
     '''
     
+    course_id = Parameter()
     title = Parameter()
-    page_source = PageSourceParameter()
     is_test_run = BoolParameter(default=True)
     
+    # where the lecture's page source is cached ({'master_URL', 'title', 'shared_cache'}, see "load_page_source")
+    cache_entry = DictParameter(significant=False)
+    
     # NOTE: nothing is "required"
     
-    def output(self):
-        timestamp_to_thumbnail_link = get_timestamp_to_thumbnail_link(self.page_source)
+    def get_timestamp_to_thumbnail_link(self):
+        '''
+        load the slide links of this lecture from its cached page source
+        '''
         
-        # get the folder name
-        folder_name = clean_file_name(self.title) + ' slides'
+        # output is called many times while scheduling, so the (small) links are kept instead of the (big) page source
+        if not hasattr(self, '_timestamp_to_thumbnail_link'):
+            page_source = load_page_source(**self.cache_entry)
+            self._timestamp_to_thumbnail_link = get_timestamp_to_thumbnail_link(page_source)
+        
+        return self._timestamp_to_thumbnail_link
+    
+    def get_folder_path(self):
+        return os.path.join(get_course_path(self.course_id, self.is_test_run), clean_file_name(self.title) + ' slides')
+    
+    def output(self):
+        timestamp_to_thumbnail_link = self.get_timestamp_to_thumbnail_link()
         
         timestamp_to_LocalTarget = {}
         for timestamp in timestamp_to_thumbnail_link:
@@ -156,12 +507,13 @@ class DownloadSlides(Task):
             file_name = timestamp_to_file_name(timestamp)
             
             # get the full file path
-            file_path = os.path.join(VIDEO_PATH, folder_name, file_name)
+            file_path = os.path.join(self.get_folder_path(), file_name)
             
             timestamp_to_LocalTarget[timestamp] = LocalTarget(file_path, format=luigi.format.Nop)
         
+        # if doing a test, only download a few (evenly spaced) slides
         if self.is_test_run is True:
-            return dict(list(timestamp_to_LocalTarget.items())[:2])
+            return dict(sample_evenly(list(timestamp_to_LocalTarget.items()), SMOKE_SLIDES))
         return timestamp_to_LocalTarget
     
     
@@ -170,20 +522,20 @@ class DownloadSlides(Task):
         
         # if we are running we need to first delete the folder (if it already exists)
         # this is because luigi will get stuck on individual file renames (from tmp_path to path) if the file already exists
-        folder_path = os.path.join(VIDEO_PATH, clean_file_name(self.title) + ' slides')
+        folder_path = self.get_folder_path()
         try:
             shutil.rmtree(folder_path)
         except FileNotFoundError:
             pass
         
-        timestamp_to_thumbnail_link = get_timestamp_to_thumbnail_link(self.page_source)
-        
-        # if doing a test, only download a few slides
-        if self.is_test_run is True:
-            timestamp_to_thumbnail_link = dict(list(timestamp_to_thumbnail_link.items())[:2])
+        # only download the slides we have targets for (a sample if doing a test)
+        timestamp_to_LocalTarget = self.output()
+        timestamp_to_thumbnail_link = self.get_timestamp_to_thumbnail_link()
+        timestamp_to_thumbnail_link = {timestamp: thumbnail_link for timestamp, thumbnail_link in timestamp_to_thumbnail_link.items()
+                                       if timestamp in timestamp_to_LocalTarget}
         
         # download slides
-        download_lecture_slides(timestamp_to_thumbnail_link, title="NOT_IN_USE", timestamp_to_LocalTarget=self.output())
+        download_lecture_slides(timestamp_to_thumbnail_link, title="NOT_IN_USE", timestamp_to_LocalTarget=timestamp_to_LocalTarget)
     
     def complete(self):
         '''
@@ -200,34 +552,60 @@ class UploadSlides(Task):
     upload slides from a single lecture to S3 (will download slides first if needed)
     '''
     
+    course_id = Parameter()
     title = Parameter()
-    page_source = PageSourceParameter()
     is_test_run = BoolParameter(default=True)
     
-    def requires(self):
-        return DownloadSlides(title=self.title, page_source=self.page_source, is_test_run=self.is_test_run)
+    # where the lecture's page source is cached (see DownloadSlides)
+    cache_entry = DictParameter(significant=False)
+    
+    # if set, the slides are removed from disk once they are uploaded (see UploadLecture)
+    disk_budget = IntParameter(default=None, significant=False)
+    
+    @property
+    def resources(self):
+        # with a disk budget, reserve (a generous estimate of) the size of the slides (see UploadLecture)
+        if self.disk_budget is None:
+            return {}
+        estimated_size = len(self.get_download_task().output()) * ESTIMATED_SLIDE_SIZE
+        return {'disk': get_disk_reservation(estimated_size, self.disk_budget)}
+    
+    def get_download_task(self):
+        return DownloadSlides(course_id=self.course_id, title=self.title, is_test_run=self.is_test_run,
+                              cache_entry=self.cache_entry)
+    
+    # NOTE: nothing is "required". the slides are downloaded in run instead (see UploadLecture)
     
     def output(self):
         # generate S3Target's from DownloadSlides LocalTarget's
+        # note: DownloadSlides already picked the sample (and smoke folder) if doing a test
         timestamp_to_S3Target = {timestamp: S3Target(LocalTarget_obj.path.replace(VIDEO_PATH, S3_ROOT).replace('\\', '/'),
                                                      format=luigi.format.Nop)
-                                 for timestamp, LocalTarget_obj in self.requires().output().items()}
+                                 for timestamp, LocalTarget_obj in self.get_download_task().output().items()}
         
-        # run over a small subset of is_test is True. this is redundant if DownloadSlides was already a subset
-        if self.is_test_run is True:
-            return dict(list(timestamp_to_S3Target.items())[:2])
         return timestamp_to_S3Target
     
     
     def run(self):
         print('*'*25, 'started uploading slides', '*'*25)
         
+        download_task = self.get_download_task()
+        timestamp_to_LocalTarget = download_task.output()
+        
+        # download the slides here (unless they are already on disk)
+        if not download_task.complete():
+            download_task.run()
+        
         # note: unlike in windows, you do not have to delete the lecture folder before writing/re-writing data
         # because renaming a file to an existing name does not cause a problem
         
         for timestamp in self.output():
-            with self.input()[timestamp].open('r') as inf, self.output()[timestamp].open('w') as outf:
+            with timestamp_to_LocalTarget[timestamp].open('r') as inf, self.output()[timestamp].open('w') as outf:
                 outf.write(inf.read())
+        
+        # the slides are uploaded, so free up the disk space (later runs see they are done through S3)
+        if self.disk_budget is not None:
+            shutil.rmtree(download_task.get_folder_path(), ignore_errors=True)
     
     def complete(self):
         '''
@@ -243,59 +621,195 @@ class UploadSlides(Task):
 #-------------------------------------------------- wrapper tasks --------------------------------------------------
 #-------------------------------------------------------------------------------------------------------------------
 
+class RunProgress:
+    '''
+    print an overall, byte based ETA every time a lecture task finishes
+    '''
+    
+    def __init__(self, tasks, LectureProcess, is_shared=False):
+        '''
+        is_shared (bool) : if true, other hosts take tasks from the same list (distributed mode without --shard). the tasks
+                           they finish never show up here, so only this host's own progress (without an ETA) is printed
+        '''
+        
+        # only lectures that still need to run count towards the total. start with every lecture and take off the ones luigi
+        # finds complete while scheduling (so completeness is only checked once, by luigi)
+        self.total_bytes = sum(task.estimated_size or 0 for task in tasks if isinstance(task, LectureProcess))
+        self.is_shared = is_shared
+        
+        # note: with more than one worker, tasks run in forked processes, so the counter has to live in shared memory
+        self.done_bytes = multiprocessing.Value('q', 0)
+        self.start_time = time.time()
+        
+        LectureProcess.event_handler(Event.DEPENDENCY_PRESENT)(self.on_present)
+        LectureProcess.event_handler(Event.SUCCESS)(self.on_success)
+    
+    def on_present(self, task):
+        # note: scheduling happens in the main process before any worker is forked, so total_bytes can be a plain int
+        self.total_bytes -= task.estimated_size or 0
+    
+    def on_success(self, task):
+        with self.done_bytes.get_lock():
+            self.done_bytes.value += task.estimated_size or 0
+            done_bytes = self.done_bytes.value
+        
+        elapsed = time.time() - self.start_time
+        if done_bytes == 0 or elapsed == 0:
+            return
+        
+        if self.is_shared is True:
+            print('INFO: this host has done {:.1f} GB ({:.1f} MB/s)'.format(done_bytes / 1024**3, done_bytes / 1048576 / elapsed))
+            return
+        
+        if self.total_bytes == 0:
+            return
+        
+        # assume the rest of the run goes as fast as it has so far
+        eta = datetime.timedelta(seconds=round(elapsed * (self.total_bytes - done_bytes) / done_bytes))
+        
+        print('INFO: {:.1f} of {:.1f} GB done ({:.0%}), ETA {}'.format(done_bytes / 1024**3, self.total_bytes / 1024**3,
+                                                                      done_bytes / self.total_bytes, eta))
+
+
+def is_in_shard(task, shard_index, num_shards):
+    '''
+    deterministically decide if a task belongs to shard shard_index (of num_shards)
+    
+    note: the md5 of the key is the same on every machine (unlike python's hash), so every host agrees on the split. the key
+    only uses parameters that never change (the url is rewritten whenever an expired link is refreshed)
+    '''
+    
+    # lectures are named by their base_file_name, slides by their title (both only unique within their course)
+    if hasattr(task, 'base_file_name'):
+        key = 'lecture|' + task.course_id + '|' + task.base_file_name
+    else:
+        key = 'slides|' + task.course_id + '|' + task.title
+    key += '|' + str(task.is_test_run)
+    
+    return int(hashlib.md5(key.encode()).hexdigest(), 16) % num_shards == shard_index
+
+
 class ProcessAllLectures(Task):
     '''
-    an abstract class that runs some task for each lecture
+    an abstract class that runs some task for each lecture of each course
     '''
     
-    master_URL = Parameter()
+    master_URLs = ListParameter()
     process_slides = BoolParameter()
     is_test_run = BoolParameter(default=True)
+    shared_cache = BoolParameter(default=False)
+    
+    # only run the tasks of one shard (by default, there is a single shard that has every task)
+    shard_index = IntParameter(default=0)
+    num_shards = IntParameter(default=1)
+    
+    workers = IntParameter(default=1, significant=False)
+    
+    # only used by uploads (see UploadLecture)
+    disk_budget = IntParameter(default=None, significant=False)
     
     LectureProcess = NotImplemented
     SlideProcess = NotImplemented
     
     def requires(self):
-        # fist we need to make sure we have the link data
-        self.saved_lecture_data = SaveLectureData(master_URL=self.master_URL)
-        yield self.saved_lecture_data
+        # fist we need to make sure we have the link data (for all courses)
+        return SaveAllLectureData(master_URLs=self.master_URLs, shared_cache=self.shared_cache)
     
     def complete(self):
         return False
     # note: we always want to try to call run. it will do nothing if all subtasks have already happened.
     
-    def run(self):
-        # load saved data
-        with self.saved_lecture_data.output().open('r') as cache: # TODO: HERE IS THE PROBLEM!
-            data = pickle.load(cache)
-        title_to_best_m3u8 = data['title_to_best_m3u8']
-        player_type = data['player_type']
-        title_to_page_source = data['title_to_page_source']
+    def get_course_tasks(self, master_URL, index):
+        '''
+        build the lecture and slide tasks for a single course from its cache index
+        '''
+        
+        player_type = index['player_type']
+        course_id = get_course_id(master_URL)
+        
+        # only pass the disk budget if there is one (downloads don't have the parameter)
+        budget_params = {'disk_budget': self.disk_budget} if self.disk_budget is not None else {}
         
         # now we can process (download / upload) all the videos
         lecture_tasks = []
         slide_tasks = []
-        for title, urls in title_to_best_m3u8.items():
+        for title, lecture in index['title_to_lecture'].items():
+            urls = lecture['best_m3u8s']
+            lecture_infos = lecture['lecture_infos']
+            
             for url_num in range(len(urls)):
                 # add lecture tasks
                 full_title = title + ' - perspective' + str(url_num)
+                lecture_info = lecture_infos[url_num] if url_num < len(lecture_infos) else {}
+                
+                # a test run only downloads a small sample, so use the size of the sample instead
+                # note: caches written before smoke sizes were recorded don't have one
+                if self.is_test_run is True:
+                    lecture_info = {'size': lecture_info.get('smoke_size')}
                 
-                task = self.LectureProcess(base_file_name=full_title,
+                task = self.LectureProcess(course_id=course_id,
+                                           base_file_name=full_title,
                                            url=urls[url_num],
                                            player=player_type,
-                                           timeout_max=1 if self.is_test_run else None)
+                                           is_test_run=self.is_test_run,
+                                           estimated_size=lecture_info.get('size'),
+                                           estimated_duration=lecture_info.get('duration'),
+                                           cache_entry={'master_URL': master_URL,
+                                                        'title': title,
+                                                        'url_num': url_num,
+                                                        'shared_cache': self.shared_cache},
+                                           **budget_params)
                 lecture_tasks.append(task)
             
             # add slide tasks if possible and wanted
+            # note: slide tasks only load their page source when they are scheduled
             if player_type == 'panopto' and self.process_slides is True:
-                task = self.SlideProcess(title=title,
-                                         page_source=title_to_page_source[title],
-                                         is_test_run=self.is_test_run)
+                task = self.SlideProcess(course_id=course_id,
+                                         title=title,
+                                         is_test_run=self.is_test_run,
+                                         cache_entry={'master_URL': master_URL,
+                                                      'title': title,
+                                                      'shared_cache': self.shared_cache},
+                                         **budget_params)
                 slide_tasks.append(task)
         
-        # actually run the tasks
-        build(lecture_tasks, local_scheduler=True) # TODO: add more workers?
-        build(slide_tasks, local_scheduler=True) # TODO: add more workers?
+        return lecture_tasks, slide_tasks
+    
+    def get_tasks(self):
+        '''
+        build the lecture and slide tasks (of this shard) for every course
+        '''
+        
+        lecture_tasks = []
+        slide_tasks = []
+        for master_URL, target in self.input().items():
+            # load the saved index (without any page sources)
+            index = read_index(target)
+            
+            course_lecture_tasks, course_slide_tasks = self.get_course_tasks(master_URL, index)
+            lecture_tasks += course_lecture_tasks
+            slide_tasks += course_slide_tasks
+        
+        # longest lectures first (the scheduler also uses each task's priority)
+        lecture_tasks.sort(key=lambda task: task.estimated_size or 0, reverse=True)
+        
+        return [task for task in lecture_tasks + slide_tasks if is_in_shard(task, self.shard_index, self.num_shards)]
+    
+    def run(self):
+        tasks = self.get_tasks()
+        
+        # report an overall ETA as lectures finish
+        RunProgress(tasks, self.LectureProcess)
+        
+        # the disk budget is a luigi resource that every lecture reserves its (estimated) size of
+        if self.disk_budget is not None:
+            config = luigi.configuration.get_config()
+            if not config.has_section('resources'):
+                config.add_section('resources')
+            config.set('resources', 'disk', str(get_disk_budget_MB(self.disk_budget)))
+        
+        # actually run the tasks (every course shares a single scheduling pass)
+        build(tasks, local_scheduler=True, workers=self.workers)
 
 
 class DownloadAllLectures(ProcessAllLectures):
@@ -0,0 +1,99 @@
+import cProfile
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from .globals import DATA_PATH
+TRACE_PATH = os.path.join(DATA_PATH, 'tmp/trace.json')
+PROFILE_PATH = os.path.join(DATA_PATH, 'tmp/profiles')
+
+
+# tracing is off unless "enable_tracing" is called (by the --profile flag)
+_trace_events = None
+_profile_path = None
+_profile_count = 0
+_start_time = time.perf_counter()
+
+
+def enable_tracing(use_cprofile=False):
+    '''
+    start recording timing spans (and cProfile dumps of the CPU heavy stages if use_cprofile is True)
+    '''
+    
+    global _trace_events, _profile_path
+    
+    _trace_events = []
+    
+    if use_cprofile is True:
+        _profile_path = PROFILE_PATH
+        os.makedirs(_profile_path, exist_ok=True)
+
+
+@contextmanager
+def span(name, **args):
+    '''
+    record the time spent in a with block as a "complete" event of the Chrome trace-event format
+    
+    spans nest naturally (by time) in chrome://tracing or https://ui.perfetto.dev. args are shown with the span
+    '''
+    
+    if _trace_events is None:
+        yield
+        return
+    
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        # note: timestamps / durations are in microseconds
+        _trace_events.append({'name': name,
+                              'ph': 'X',
+                              'ts': (start - _start_time) * 1e6,
+                              'dur': (end - start) * 1e6,
+                              'pid': os.getpid(),
+                              'tid': threading.get_ident(),
+                              'args': args})
+
+
+@contextmanager
+def profile(name, **args):
+    '''
+    a span that also dumps a cProfile of the with block to PROFILE_PATH/<num>_<name>.prof (if cProfile dumps are enabled)
+    '''
+    
+    global _profile_count
+    
+    with span(name, **args):
+        if _profile_path is None:
+            yield
+            return
+        
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            
+            # number the dumps so stages that run once per course don't overwrite each other
+            _profile_count += 1
+            profiler.dump_stats(os.path.join(_profile_path, '{:03}_{}.prof'.format(_profile_count, name)))
+
+
+def save_trace(trace_path=TRACE_PATH):
+    '''
+    write all recorded spans to a Chrome trace-event file (does nothing if tracing is off)
+    
+    return: the path of the trace file (or None)
+    '''
+    
+    if _trace_events is None:
+        return None
+    
+    with open(trace_path, 'w') as f:
+        json.dump({'traceEvents': _trace_events, 'displayTimeUnit': 'ms'}, f)
+    
+    return trace_path
@@ -5,14 +5,21 @@ from selenium.webdriver.chrome.options import Options as ChromeOptions
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
+from selenium.common.exceptions import TimeoutException
 
 from bs4 import BeautifulSoup
+# imports for the encrypted session cache
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+import base64
 import os
 import json
 import requests
 import re
 from tqdm import tqdm
 import time
+from urllib.parse import urljoin, urlsplit
 
 
 # get credentials
@@ -20,11 +27,20 @@ CANVAS_USERNAME = os.getenv('CANVAS_USERNAME')
 CANVAS_PASSWORD = os.getenv('CANVAS_PASSWORD')
 
 from .globals import *
+from .writer import LectureWriter
+from .profiling import span, profile
 LOG_PATH = os.path.join(DATA_PATH, 'tmp/net_log.json')
 DRIVER_PATH = os.path.join(DATA_PATH, 'drivers/chromedriver')
+SESSION_PATH = os.path.join(DATA_PATH, 'tmp/canvas_session.bin')
 
 DEFAULT_TIMEOUT = 30
 
+CANVAS_URL = 'https://canvas.harvard.edu'
+MATTERHORN_URL = 'https://matterhorn.dce.harvard.edu'
+PANOPTO_URL = 'https://harvard.hosted.panopto.com'
+# canvas session cookies do not carry an expiry date, so assume a cached session is stale after 12 hours
+SESSION_MAX_AGE = 12*60*60
+
 
 # SOME INITIAL RESEARCH:
 # chomedriver: https://sites.google.com/a/chromium.org/chromedriver/ / https://chromedriver.chromium.org/
@@ -50,18 +66,202 @@ def generate_driver():
     return driver
 
 
-def setup_and_login(default_2FA=True):
+# --------------------------------------------------------------------------------------------------------------------
+#-------------------------------------------------- session code STARTS --------------------------------------------------
+# --------------------------------------------------------------------------------------------------------------------
+
+def get_session_fernet(salt):
+    '''
+    return a Fernet object whose key is derived from CANVAS_PASSWORD (so the session cache needs no extra secret)
+    '''
+    
+    kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=salt, iterations=200000)
+    key = base64.urlsafe_b64encode(kdf.derive((CANVAS_PASSWORD or '').encode()))
+    return Fernet(key)
+
+
+def save_session(driver, merge=False):
+    '''
+    encrypt and save the cookies of an authenticated driver to SESSION_PATH
+    
+    merge (bool) : if true, add the cookies of the current page (ex: a player's domain) to the cached session instead of
+                   replacing it. nothing is saved if there is no cached session to merge into
+    '''
+    
+    # note: get_cookies only returns the cookies of the domain that is currently open
+    cookies = driver.get_cookies()
+    
+    if merge is True:
+        session_data = load_session_data()
+        if session_data is None:
+            return
+        
+        # replace old versions of the new cookies, keep everything else (and the expiry of the canvas session)
+        new_keys = {(cookie['name'], cookie.get('domain')) for cookie in cookies}
+        cookies = [cookie for cookie in session_data['cookies']
+                   if (cookie['name'], cookie.get('domain')) not in new_keys] + cookies
+        expires_at = session_data['expires_at']
+    else:
+        # the session expires at the earliest cookie expiry (or after SESSION_MAX_AGE if that comes first)
+        expires_at = time.time() + SESSION_MAX_AGE
+        for cookie in cookies:
+            if 'expiry' in cookie:
+                expires_at = min(expires_at, cookie['expiry'])
+    
+    session_data = json.dumps({'cookies': cookies, 'expires_at': expires_at}).encode()
+    
+    # the salt is stored (unencrypted) in front of the token
+    salt = os.urandom(16)
+    with open(SESSION_PATH, 'wb') as f:
+        f.write(salt + get_session_fernet(salt).encrypt(session_data))
+
+
+def delete_session():
+    '''
+    remove the session cache (if it exists)
+    '''
+    
+    try:
+        os.remove(SESSION_PATH)
+    except FileNotFoundError:
+        pass
+
+
+def load_session_data():
+    '''
+    return the cached session ({'cookies', 'expires_at'}), or None if there is no cache, it can't be decrypted, or it has
+    expired
+    '''
+    
+    try:
+        with open(SESSION_PATH, 'rb') as f:
+            content = f.read()
+    except FileNotFoundError:
+        return None
+    
+    salt, token = content[:16], content[16:]
+    try:
+        session_data = json.loads(get_session_fernet(salt).decrypt(token))
+    except InvalidToken:
+        # written with a different password (or corrupted)
+        print('INFO: could not decrypt the session cache, a full login is needed')
+        delete_session()
+        return None
+    
+    if time.time() >= session_data['expires_at']:
+        print('INFO: the cached session has expired, a full login is needed')
+        delete_session()
+        return None
+    
+    return session_data
+
+
+def load_session():
+    '''
+    return the cached cookies, or None if there is no usable session cache
+    '''
+    
+    session_data = load_session_data()
+    if session_data is None:
+        return None
+    return session_data['cookies']
+
+
+def get_canvas_session(cookies=None):
+    '''
+    return a requests.Session that is authenticated with the cached (or given) canvas cookies
+    
+    return: None if no usable session exists
+    '''
+    
+    if cookies is None:
+        cookies = load_session()
+        if cookies is None:
+            return None
+    
+    session = requests.Session()
+    for cookie in cookies:
+        session.cookies.set(cookie['name'], cookie['value'], domain=cookie.get('domain'), path=cookie.get('path', '/'))
+    
+    return session
+
+
+def is_session_valid(cookies):
+    '''
+    check (over plain HTTP) if canvas still accepts a set of cookies
+    '''
+    
+    with get_canvas_session(cookies) as session:
+        # canvas answers 401 (or redirects to the login page) if the session has been rejected
+        r = session.get(CANVAS_URL + '/api/v1/users/self', allow_redirects=False)
+    
+    return r.status_code == 200
+
+
+def is_cookie_for_host(cookie, host):
+    '''
+    check if a cookie is sent to host (its domain is host, or a parent domain of host)
+    '''
+    
+    domain = cookie.get('domain', '').lstrip('.').lower()
+    if domain == '':
+        return False
+    return host == domain or host.endswith('.' + domain)
+
+
+def restore_session(driver, cookies):
+    '''
+    inject cached cookies into a driver and check that canvas accepts them
+    
+    return: True if the driver is now logged in
+    '''
+    
+    # cookies can only be added for the domain that is currently open, so open a canvas page that does not redirect
+    driver.get(CANVAS_URL + '/robots.txt')
+    
+    canvas_host = urlsplit(CANVAS_URL).hostname
+    for cookie in cookies:
+        if is_cookie_for_host(cookie, canvas_host):
+            driver.add_cookie(cookie)
+    
+    # wait for dashboard to load (a rejected session ends up on the login page instead)
+    driver.get(CANVAS_URL + '/')
+    try:
+        _ = WebDriverWait(driver, DEFAULT_TIMEOUT).until(EC.presence_of_element_located((By.ID, 'dashboard')))
+    except TimeoutException:
+        return False
+    
+    return True
+
+# ------------------------------------------------------------------------------------------------------------------
+#-------------------------------------------------- session code ENDS --------------------------------------------------
+# ------------------------------------------------------------------------------------------------------------------
+
+def setup_and_login(default_2FA=True, use_cached_session=True):
     '''
     automatically walk through the process of starting Canvas and passing 2FA
     
     default_2FA (bool) : if true, automatically 'call' the fist 2FA method presented
+    use_cached_session (bool) : if true, try to reuse the cached session (skipping login and 2FA) before logging in
     '''
     
     # step 0: start a configured driver
     driver = generate_driver()
     
+    # step 0.25: try to reuse a cached session
+    if use_cached_session is True:
+        cookies = load_session()
+        
+        # check the session over plain HTTP first so a rejected session doesn't cost a dashboard timeout
+        if cookies is not None and is_session_valid(cookies) and restore_session(driver, cookies):
+            print('INFO: reusing cached canvas session')
+            return driver
+        
+        # the session was rejected, so don't try it again
+        delete_session()
+    
     # step 0.5: open the base canvas url --> triggers a login scree
-    driver.get('https://canvas.harvard.edu/')
+    driver.get(CANVAS_URL + '/')
     
     
     #-------------------------------------------------------
@@ -103,6 +303,11 @@ def setup_and_login(default_2FA=True):
     print('INFO: if 2FA is not completed within 120s, this program will exit automatically')
     _ = WebDriverWait(driver, 120).until(EC.presence_of_element_located((By.ID, 'dashboard')))
     
+    # cache the session so the next run can skip all of this
+    # note: get_cookies only sees the cookies of the current frame, so make sure we are out of the 2FA iframe
+    driver.switch_to.default_content()
+    save_session(driver)
+    
     # return the authenticated driver object
     return driver
 
@@ -195,11 +400,13 @@ def extract_lecture_links(player_page_source, player):
     return lecture_to_url
 
 
-def open_lecture_links(driver, lecture_to_url, player):
+def open_lecture_links(driver, lecture_to_url, player, quit_driver=True):
     '''
     given a driver, a lecture_to_url dict, and a player: open each link in lecture_to_url
     
     this allows the driver to track the network activity generated from each lecture page
+    
+    quit_driver (bool) : if true, quit the driver once all links are open (set to false to keep using the session)
     '''
     
     # (probably not needed) make sure the player is valid
@@ -209,25 +416,27 @@ def open_lecture_links(driver, lecture_to_url, player):
     
     # open each link
     for title, link in lecture_to_url.items():
-        # go to the link
-        driver.get(link)
-        
-        # wait for the page to fully load
-        if player == 'matterhorn':
-            # wait for the play button to appear
-            _ = WebDriverWait(driver, DEFAULT_TIMEOUT).until(EC.presence_of_element_located(
-                (By.ID, 'paella_plugin_PlayButtonOnScreen')))
-        elif player == 'panopto':
-            # wait for the loading image to appeaer
-            _ = WebDriverWait(driver, DEFAULT_TIMEOUT).until(EC.presence_of_element_located((By.ID, 'loadingMessage')))
-            # waif for the loading image to disappear (finished loading)
-            _ = WebDriverWait(driver, DEFAULT_TIMEOUT).until(EC.invisibility_of_element_located((By.ID, 'loadingMessage')))
+        with span('open lecture', title=title):
+            # go to the link
+            driver.get(link)
             
-            # save the page source
-            title_to_page_source[title] = driver.page_source
+            # wait for the page to fully load
+            if player == 'matterhorn':
+                # wait for the play button to appear
+                _ = WebDriverWait(driver, DEFAULT_TIMEOUT).until(EC.presence_of_element_located(
+                    (By.ID, 'paella_plugin_PlayButtonOnScreen')))
+            elif player == 'panopto':
+                # wait for the loading image to appeaer
+                _ = WebDriverWait(driver, DEFAULT_TIMEOUT).until(EC.presence_of_element_located((By.ID, 'loadingMessage')))
+                # waif for the loading image to disappear (finished loading)
+                _ = WebDriverWait(driver, DEFAULT_TIMEOUT).until(EC.invisibility_of_element_located((By.ID, 'loadingMessage')))
+                
+                # save the page source
+                title_to_page_source[title] = driver.page_source
     
     # we are done with driver so we can 'quit' it
-    driver.quit()
+    if quit_driver is True:
+        driver.quit()
     
     return title_to_page_source
 
@@ -357,6 +566,26 @@ def extract_m3u8s_from_netlog():
     return all_lecture_m3u8s
 
 
+def get_stream_key(m3u8):
+    '''
+    return the part of an m3u8 link that identifies its stream (its path, without the signed query string)
+    '''
+    
+    return urlsplit(m3u8).path
+
+
+def sort_m3u8s(m3u8s, reference_m3u8s=()):
+    '''
+    put the m3u8s of a lecture in a stable order, so perspective N is always the same camera (no matter if the links came
+    from the net log or from "fetch_lecture_m3u8s")
+    
+    m3u8s that match (by stream key) one of reference_m3u8s keep its order, the rest are sorted by stream key
+    '''
+    
+    position = {get_stream_key(m3u8): i for i, m3u8 in enumerate(reference_m3u8s)}
+    return sorted(m3u8s, key=lambda m3u8: (position.get(get_stream_key(m3u8), len(position)), get_stream_key(m3u8)))
+
+
 def get_title_to_m3u8s(lecture_to_url, all_lecture_m3u8s, player):
     '''
     build a dict that links titles to m3u8s using lecture_to_url (extracted from HTML) and all_lecture_m3u8s (from net log)
@@ -388,7 +617,7 @@ def get_title_to_m3u8s(lecture_to_url, all_lecture_m3u8s, player):
     
     if player == 'matterhorn':
         # in matterhorn, the lecture_id is id1 (the base id) so we can just grab the m3u8s directly
-        return {title: id1_to_m3u8s[id1] for title, id1 in title_to_lecture_id.items()}
+        return {title: sort_m3u8s(id1_to_m3u8s[id1]) for title, id1 in title_to_lecture_id.items()}
     
     elif player == 'panopto':
         id2_to_id1 = {}
@@ -399,100 +628,387 @@ def get_title_to_m3u8s(lecture_to_url, all_lecture_m3u8s, player):
         # note: this will build a many-to-one dict
 
         # in panopto, the lecture_id is id2 (the second id) so we need to first get the (base) id1 for each id2
-        return {title: id1_to_m3u8s[id2_to_id1[id2]] for title, id2 in title_to_lecture_id.items()}
+        return {title: sort_m3u8s(id1_to_m3u8s[id2_to_id1[id2]]) for title, id2 in title_to_lecture_id.items()}
 
 
-def get_title_to_download_links(title_to_m3u8s, player):
+def get_title_to_download_links(title_to_m3u8s, player, return_info=False):
     '''
     extract final download links from list of possible m3u8 files
+    
+    return_info (bool) : if true, also return a title_to_lecture_info dict that holds the estimated duration and size of
+                         each link (see "estimate_lecture_info")
     '''
     
     title_to_best_m3u8 = {}
+    title_to_lecture_info = {}
 
     for title, m3u8_list in title_to_m3u8s.items():
         max_resolution_m3u8s = []
+        lecture_infos = []
         
-        # for each m3u8 url...
-        for m3u8 in m3u8_list:
-            
-            # get the full content
-            m3u8_content = requests.get(m3u8).content.decode()
-            
-            # if we're looking at a 'master' file (a file with links to other files), do stuff...
-            if '#EXT-X-STREAM-INF' in m3u8_content:
-                #-------------------- find the m3u8 varient with the max resolution --------------------
-                #---------------------------------------------------------------------------------------
-                
-                resolution_dict = {}
-                
-                # convert to line-by-line content
-                m3u8_content = m3u8_content.splitlines()
-                
-                # itterate over the lines...
-                for i in range(len(m3u8_content)):
-                    line = m3u8_content[i]
-
-                    # TODO: add explanation here
-                    if line.startswith('#EXT-X-STREAM-INF'):
-                        # use a regex to match some '<num>x<num>'. this is the resolution (found after a 'RESOLUTION=' tag)
-                        resolution = re.findall('\d*x\d*', line)[0]
-                        
-                        # grab the next line which stores the extension of the resolution variant
-                        m3u8_extension = m3u8_content[i+1]
-                        
-                        resolution_dict[resolution] = m3u8_extension
-                
-                # GET THE MAX
-                max_prod = -1
-                max_resolution = None
-                for resolution in resolution_dict.keys():
-                    x, y = resolution.split('x')
-                    prod = int(x)*int(y)
-
-                    if prod > max_prod:
-                        max_prod = prod
-                        max_resolution = resolution
-                
-                # get the m3u8 extension at the max resolution
-                m3u8_extension = resolution_dict[max_resolution]
-                
-                #-------------------- find the full link using the base and the max resolution extension --------------------
-                #------------------------------------------------------------------------------------------------------------
+        with span('resolve lecture', title=title):
+            # for each m3u8 url...
+            for m3u8 in m3u8_list:
                 
-                if player == 'matterhorn':
-                    base_re = 'https://dvgni8clk4vbh.cloudfront.net/engage-player/[\w-]*/'
-                elif player == 'panopto':
-                    base_re = 'https://d2y36twrtb17ty.cloudfront.net/sessions/[\w-]*/[.\w-]*/'
+                # get the full content
+                m3u8_content = requests.get(m3u8).content.decode()
                 
-                # extract the base from the m3u8 link
-                base_m3u8 = re.findall(base_re, m3u8)[0]
-                
-                if player == 'matterhorn':
-                    full_m3u8 = base_m3u8 + m3u8_extension[3:]
-                    m3u8_content = requests.get(full_m3u8).content.decode()
+                # if we're looking at a 'master' file (a file with links to other files), do stuff...
+                if '#EXT-X-STREAM-INF' in m3u8_content:
+                    #-------------------- find the m3u8 varient with the max resolution --------------------
+                    #---------------------------------------------------------------------------------------
+                    
+                    resolution_dict = {}
+                    resolution_to_bandwidth = {}
+                    
+                    # convert to line-by-line content
+                    m3u8_content = m3u8_content.splitlines()
+                    
+                    # itterate over the lines...
+                    for i in range(len(m3u8_content)):
+                        line = m3u8_content[i]
+    
+                        # TODO: add explanation here
+                        if line.startswith('#EXT-X-STREAM-INF'):
+                            # use a regex to match some '<num>x<num>'. this is the resolution (found after a 'RESOLUTION=' tag)
+                            resolution = re.findall('\d*x\d*', line)[0]
+                            
+                            # grab the next line which stores the extension of the resolution variant
+                            m3u8_extension = m3u8_content[i+1]
+                            
+                            resolution_dict[resolution] = m3u8_extension
+                            
+                            # keep the bandwidth (bits/s) around for size estimates
+                            bandwidth = parse_attribute_list(line.split(':', 1)[1]).get('BANDWIDTH')
+                            resolution_to_bandwidth[resolution] = int(bandwidth) if bandwidth is not None else None
                     
-                    # extract the mp4 link from the m3u8 content
-                    mp4_extension = re.findall('../.*.mp4', m3u8_content)[0]
+                    # GET THE MAX
+                    max_prod = -1
+                    max_resolution = None
+                    for resolution in resolution_dict.keys():
+                        x, y = resolution.split('x')
+                        prod = int(x)*int(y)
+    
+                        if prod > max_prod:
+                            max_prod = prod
+                            max_resolution = resolution
                     
-                    # add the mp4 link to the list
-                    max_resolution_m3u8s.append(base_m3u8 + mp4_extension[3:])
-                elif player == 'panopto':
-                    full_m3u8 = base_m3u8 + m3u8_extension
+                    # get the m3u8 extension at the max resolution
+                    m3u8_extension = resolution_dict[max_resolution]
                     
-                    # add the ts list
-                    max_resolution_m3u8s.append(full_m3u8)
+                    #-------------------- find the full link using the base and the max resolution extension --------------------
+                    #------------------------------------------------------------------------------------------------------------
+                    
+                    if player == 'matterhorn':
+                        base_re = 'https://dvgni8clk4vbh.cloudfront.net/engage-player/[\w-]*/'
+                    elif player == 'panopto':
+                        base_re = 'https://d2y36twrtb17ty.cloudfront.net/sessions/[\w-]*/[.\w-]*/'
+                    
+                    # extract the base from the m3u8 link
+                    base_m3u8 = re.findall(base_re, m3u8)[0]
+                    
+                    if player == 'matterhorn':
+                        full_m3u8 = base_m3u8 + m3u8_extension[3:]
+                        m3u8_content = requests.get(full_m3u8).content.decode()
+                        
+                        # extract the mp4 link from the m3u8 content
+                        mp4_extension = re.findall('../.*.mp4', m3u8_content)[0]
+                        
+                        # add the mp4 link to the list
+                        max_resolution_m3u8s.append(base_m3u8 + mp4_extension[3:])
+                        
+                        if return_info is True:
+                            # the variant playlist has the durations, the mp4 itself has the exact size
+                            mp4_head = requests.head(max_resolution_m3u8s[-1], allow_redirects=True)
+                            content_length = mp4_head.headers.get('Content-Length')
+                            lecture_infos.append(estimate_lecture_info(parse_media_playlist(m3u8_content, full_m3u8),
+                                                                       bandwidth=resolution_to_bandwidth[max_resolution],
+                                                                       content_length=content_length))
+                    elif player == 'panopto':
+                        full_m3u8 = base_m3u8 + m3u8_extension
+                        
+                        # add the ts list
+                        max_resolution_m3u8s.append(full_m3u8)
+                        
+                        if return_info is True:
+                            media_content = requests.get(full_m3u8).content.decode()
+                            lecture_infos.append(estimate_lecture_info(parse_media_playlist(media_content, full_m3u8),
+                                                                       bandwidth=resolution_to_bandwidth[max_resolution]))
         
         # add max_resolution_m3u8 list to the main dict
         title_to_best_m3u8[title] = max_resolution_m3u8s
+        title_to_lecture_info[title] = lecture_infos
     
+    if return_info is True:
+        return title_to_best_m3u8, title_to_lecture_info
     return title_to_best_m3u8
 
 
-def download_lecture(url, player, base_file_name, mp4_path=None, timeout_max=None):
+# -------------------------------------------------------------------------------------------------------------------------
+#-------------------------------------------------- playlist code STARTS --------------------------------------------------
+# -------------------------------------------------------------------------------------------------------------------------
+
+# the largest single request we will build when merging byte ranges (16MB)
+MAX_COALESCED_REQUEST_SIZE = 16*1048576
+
+
+def parse_attribute_list(attribute_list):
+    '''
+    parse an m3u8 attribute list (ex: 'URI="init.mp4",BYTERANGE="720@0"') into a dict
+    '''
+    
+    return {key: value.strip('"') for key, value in re.findall(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)', attribute_list)}
+
+
+def parse_byterange(byterange, previous_end=None):
+    '''
+    parse an m3u8 byte range ('<length>[@<offset>]') into an (offset, length) tuple
+    
+    previous_end (int) : the offset used when no '@<offset>' is given (the end of the previous sub-range)
+    '''
+    
+    if '@' in byterange:
+        length, offset = byterange.split('@')
+        return int(offset), int(length)
+    
+    if previous_end is None:
+        raise ValueError(f'byte range "{byterange}" has no offset and does not follow a sub-range of the same resource')
+    return previous_end, int(byterange)
+
+
+def parse_media_playlist(m3u8_content, playlist_url):
+    '''
+    parse a media playlist into a list of segment dicts
+    
+    each segment looks like {'url': str, 'byterange': (offset, length) or None, 'duration': float, 'init': dict or None}
+    where 'init' is the EXT-X-MAP (same layout, without 'duration' and 'init') that has to be written before the segment
+    '''
+    
+    segments = []
+    
+    duration = 0.0
+    byterange = None
+    init = None
+    # track where the last sub-range ended so offset-less EXT-X-BYTERANGE tags can be resolved
+    last_url, last_end = None, None
+    
+    for line in m3u8_content.splitlines():
+        line = line.strip()
+        
+        if line == '':
+            continue
+        
+        elif line.startswith('#EXTINF:'):
+            # '#EXTINF:<duration>,[<title>]'
+            duration = float(line[len('#EXTINF:'):].split(',')[0])
+        
+        elif line.startswith('#EXT-X-BYTERANGE:'):
+            # the offset can only be resolved once we know the segment url (on the next uri line)
+            byterange = line[len('#EXT-X-BYTERANGE:'):]
+        
+        elif line.startswith('#EXT-X-MAP:'):
+            attributes = parse_attribute_list(line[len('#EXT-X-MAP:'):])
+            init = {'url': urljoin(playlist_url, attributes['URI']),
+                    'byterange': parse_byterange(attributes['BYTERANGE']) if 'BYTERANGE' in attributes else None}
+        
+        elif line.startswith('#'):
+            # every other tag (and comment) does not change what we download
+            continue
+        
+        else:
+            # any non-tag line is a segment uri (.ts, .m4s, .mp4, ...)
+            segment_url = urljoin(playlist_url, line)
+            
+            if byterange is not None:
+                byterange = parse_byterange(byterange, previous_end=last_end if segment_url == last_url else None)
+                last_url, last_end = segment_url, byterange[0] + byterange[1]
+            else:
+                last_url, last_end = None, None
+            
+            segments.append({'url': segment_url, 'byterange': byterange, 'duration': duration, 'init': init})
+            
+            # reset per-segment tags
+            duration = 0.0
+            byterange = None
+    
+    return segments
+
+
+def get_download_requests(segments, max_request_size=MAX_COALESCED_REQUEST_SIZE):
+    '''
+    turn a list of segments (from "parse_media_playlist") into the smallest list of (url, byterange) requests needed
+    
+    consecutive segments that address touching byte ranges of the same resource are merged into a single request (up to
+    max_request_size bytes). init sections (EXT-X-MAP) are requested once every time they change
+    '''
+    
+    requests_list = []
+    current_init = None
+    
+    for segment in segments:
+        # write the init section before the first segment that uses it
+        if segment['init'] is not None and segment['init'] != current_init:
+            current_init = segment['init']
+            requests_list.append((current_init['url'], current_init['byterange']))
+        
+        url, byterange = segment['url'], segment['byterange']
+        
+        if requests_list and byterange is not None:
+            last_url, last_byterange = requests_list[-1]
+            
+            # merge if this sub-range starts exactly where the last one ended (and the merge is not too big)
+            if last_url == url and last_byterange is not None and last_byterange[0] + last_byterange[1] == byterange[0] \
+                    and last_byterange[1] + byterange[1] <= max_request_size:
+                requests_list[-1] = (url, (last_byterange[0], last_byterange[1] + byterange[1]))
+                continue
+        
+        requests_list.append((url, byterange))
+    
+    return requests_list
+
+
+def estimate_segments_size(segments, bandwidth=None):
+    '''
+    estimate the size (in bytes) of a list of playlist segments from their byte ranges, or the BANDWIDTH of the variant
+    times their duration
+    
+    return: the size (or None if there is no way to tell)
+    '''
+    
+    if segments and all(segment['byterange'] is not None for segment in segments):
+        return sum(segment['byterange'][1] for segment in segments)
+    
+    duration = sum(segment['duration'] for segment in segments)
+    if bandwidth and duration:
+        return int(bandwidth * duration / 8)
+    
+    return None
+
+
+def estimate_lecture_info(segments, bandwidth=None, content_length=None):
+    '''
+    estimate the duration (in seconds) and size (in bytes) of a lecture from its playlist segments
+    
+    the duration is the sum of all EXTINF tags. the size comes from (in order of preference) the Content-Length of the file,
+    the playlist byte ranges, or the BANDWIDTH of the variant times the duration. the smoke size is the size of what a test
+    run downloads (see "download_lecture")
+    
+    return: {'duration': float or None, 'size': int or None, 'smoke_size': int or None}
+    '''
+    
+    duration = sum(segment['duration'] for segment in segments) or None
+    
+    if content_length:
+        size = int(content_length)
+        # a test run only downloads the start of the file
+        smoke_size = min(size, SMOKE_BYTES)
+    else:
+        size = estimate_segments_size(segments, bandwidth)
+        # a test run only downloads a few evenly spaced segments
+        smoke_size = estimate_segments_size(sample_evenly(segments, SMOKE_SEGMENTS), bandwidth)
+    
+    return {'duration': duration, 'size': size, 'smoke_size': smoke_size}
+
+
+def estimate_download_size(session, download_requests):
+    '''
+    estimate the total size of a list of (url, byterange) requests (from "get_download_requests")
+    
+    byte ranges are exact. for whole-file segments, assume every segment is about as big as the first one (one HEAD request)
+    '''
+    
+    size = 0
+    whole_file_size = None
+    for url, byterange in download_requests:
+        if byterange is not None:
+            size += byterange[1]
+        else:
+            if whole_file_size is None:
+                r = session.head(url, allow_redirects=True)
+                whole_file_size = int(r.headers.get('Content-Length', 0))
+            size += whole_file_size
+    
+    return size or None
+
+
+def get_content_length(response):
+    '''
+    return the number of (decoded) bytes the body of a response should have (or None if that isn't known)
+    '''
+    
+    # note: with a Content-Encoding (ex: gzip), Content-Length is the size of the encoded body, not of what we write
+    if response.headers.get('Content-Encoding', 'identity') != 'identity':
+        return None
+    
+    content_length = response.headers.get('Content-Length')
+    return int(content_length) if content_length else None
+
+
+def stream_byterange(session, url, byterange, writer):
+    '''
+    stream url (or just the (offset, length) byterange of it, if given) into a LectureWriter
+    
+    raise an IOError if the body ends before the whole range (or Content-Length) was copied
+    
+    yield: the number of bytes written for each buffer
+    '''
+    
+    headers = {}
+    if byterange is not None:
+        offset, length = byterange
+        headers['Range'] = 'bytes={}-{}'.format(offset, offset + length - 1)
+    
+    with session.get(url, headers=headers, stream=True) as r:
+        r.raise_for_status()
+        r.raw.decode_content = True
+        
+        copied = 0
+        if byterange is None:
+            expected_length = get_content_length(r)
+            for num_bytes in writer.write_from(r.raw):
+                copied += num_bytes
+                yield num_bytes
+        else:
+            # some servers ignore the Range header and send the whole file, so skip ahead to the range ourselves
+            if r.status_code == 200:
+                while offset > 0:
+                    skipped = len(r.raw.read(min(offset, 1048576)))
+                    # an empty read means the file ended before the range started
+                    if skipped == 0:
+                        raise IOError(f'{url} ended before the start of byte range {byterange}')
+                    offset -= skipped
+            
+            expected_length = length
+            for num_bytes in writer.write_from(r.raw, limit=length):
+                copied += num_bytes
+                yield num_bytes
+        
+        # note: urllib3 doesn't enforce the Content-Length, so a dropped connection just looks like the end of the body
+        if expected_length is not None and copied < expected_length:
+            raise IOError(f'{url} ended after {copied} of {expected_length} bytes')
+
+# -----------------------------------------------------------------------------------------------------------------------
+#-------------------------------------------------- playlist code ENDS --------------------------------------------------
+# -----------------------------------------------------------------------------------------------------------------------
+
+def download_lecture(url, player, base_file_name, mp4_path=None, timeout_max=None, is_test_run=False):
     '''
     download a single lecture
+    
+    is_test_run (bool) : if true, only download a deterministic sample of the lecture: SMOKE_SEGMENTS evenly spaced
+                         segments (panopto) or the first SMOKE_BYTES bytes (matterhorn)
+    
+    return: the checksum dict (size, md5, sha256, S3 etag) of the downloaded file, plus how many of the planned requests
+            were finished ('requests_done' / 'requests_total', so stopped downloads can be found later)
     '''
     
+    # make sure the player is valid
+    if player not in ('matterhorn', 'panopto'):
+        raise ValueError(f'invalid player selected. player "{player}" is not in ("matterhorn", "panopto")')
+    
+    # the expected S3 ETag depends on how the file will be uploaded
+    part_size, multipart_threshold = get_multipart_config(is_test_run)
+    
     # if mp4_path is unset, set it using VIDEO_PATH and base_file_name
     if mp4_path is None:
         mp4_path = os.path.join(VIDEO_PATH, clean_file_name(base_file_name) + '.mp4')
@@ -502,41 +1018,241 @@ def download_lecture(url, player, base_file_name, mp4_path=None, timeout_max=Non
         timeout_max = 60*60
     
     if player == 'matterhorn':
-        stream = requests.get(url, stream=True)
+        # in a test run, only ask for the start of the file
+        max_bytes = SMOKE_BYTES if is_test_run is True else None
+        headers = {'Range': 'bytes=0-{}'.format(max_bytes - 1)} if max_bytes is not None else {}
+        
+        stream = requests.get(url, headers=headers, stream=True)
+        # note: cached CDN links expire (403 / 404). raise so the caller can refresh the link
+        stream.raise_for_status()
+        stream.raw.decode_content = True
+        
+        # preallocate the file using the Content-Length (if we got one)
+        size_hint = int(stream.headers.get('Content-Length', 0)) or None
         
-        # download the video by making many small requests
+        # how much we should get (the server might have ignored the Range header)
+        expected_length = get_content_length(stream)
+        if expected_length is not None and max_bytes is not None:
+            expected_length = min(expected_length, max_bytes)
+        
+        # download the video by streaming it into reusable buffers
+        requests_total = 1
+        requests_done = 0
+        copied = 0
         start_time = time.time()
-        with open(mp4_path, 'wb') as f:
-            for chunk in tqdm(stream.iter_content(chunk_size=1048576), desc='downloading lecture'):
-                f.write(chunk)
+        with LectureWriter(mp4_path, size_hint=size_hint, part_size=part_size,
+                           multipart_threshold=multipart_threshold) as writer, \
+                tqdm(total=size_hint, unit='B', unit_scale=True, desc='downloading lecture') as progress:
+            # note: limit still applies if the server ignored the Range header
+            for length in writer.write_from(stream.raw, limit=max_bytes):
+                progress.update(length)
+                copied += length
                 
                 # break if over timeout_max
                 time_delta = time.time() - start_time
                 if time_delta > timeout_max:
                     print('broke from loop after {} seconds'.format(time_delta))
                     break
+            else:
+                # a dropped connection just ends the body early (see "stream_byterange")
+                if expected_length is not None and copied < expected_length:
+                    raise IOError(f'{url} ended after {copied} of {expected_length} bytes')
+                requests_done = 1
     
     if player == 'panopto':
-        m3u8_content = requests.get(url).content.decode()
+        r = requests.get(url)
+        # note: cached CDN links expire (403 / 404). raise so the caller can refresh the link
+        r.raise_for_status()
+        m3u8_content = r.content.decode()
         
-        # extact a ts list from the m3u8 content
-        ts_list = []
-        for line in m3u8_content.splitlines():
-            if line.endswith('.ts'):
-                ts_list.append(url.replace('index.m3u8', line))
+        # parse the playlist and merge byte ranges into as few requests as possible
+        segments = parse_media_playlist(m3u8_content, url)
+        if is_test_run is True:
+            segments = sample_evenly(segments, SMOKE_SEGMENTS)
+        download_requests = get_download_requests(segments)
         
-        # download the video by looping over ts files
-        with open(mp4_path, 'wb') as mp4:
+        with requests.Session() as session:
+            # preallocate the file using the playlist size estimate
+            size_hint = estimate_download_size(session, download_requests)
+            
+            # download the video by looping over the (merged) segment requests
+            requests_total = len(download_requests)
+            requests_done = 0
             start_time = time.time()
+            with LectureWriter(mp4_path, size_hint=size_hint, part_size=part_size,
+                               multipart_threshold=multipart_threshold) as writer, \
+                    tqdm(total=size_hint, unit='B', unit_scale=True, desc='downloading lecture') as progress:
+                for segment_url, byterange in download_requests:
+                    for length in stream_byterange(session, segment_url, byterange, writer):
+                        progress.update(length)
+                    requests_done += 1
+                    
+                    # break if over timeout_max
+                    time_delta = time.time() - start_time
+                    if time_delta > timeout_max:
+                        print('broke from loop after {} seconds'.format(time_delta))
+                        break
+    
+    checksum = writer.checksum.to_dict()
+    checksum['requests_done'] = requests_done
+    checksum['requests_total'] = requests_total
+    return checksum
+
+
+def get_expected_lecture_size(url, player, is_test_run=False):
+    '''
+    find the size a complete download of a lecture (see "download_lecture") should have, without downloading it
+    
+    return: (size, is_exact). sizes from byte ranges and Content-Length are exact, sizes of whole-file segments are estimated
+            from the first one (see "estimate_download_size"). size is None if it can't be found
+    '''
+    
+    if player == 'matterhorn':
+        r = requests.head(url, allow_redirects=True)
+        r.raise_for_status()
+        size = get_content_length(r)
+        if size is not None and is_test_run is True:
+            size = min(size, SMOKE_BYTES)
+        return size, size is not None
+    
+    r = requests.get(url)
+    r.raise_for_status()
+    segments = parse_media_playlist(r.content.decode(), url)
+    if is_test_run is True:
+        segments = sample_evenly(segments, SMOKE_SEGMENTS)
+    download_requests = get_download_requests(segments)
+    
+    with requests.Session() as session:
+        size = estimate_download_size(session, download_requests)
+    
+    return size, all(byterange is not None for _, byterange in download_requests)
+
+
+def get_all_lecture_data(master_URLs):
+    '''
+    given a list of master_URLs, do all operations to find video download links for every course using a single login
+    
+    return: a {master_URL: {'title_to_page_source', 'title_to_best_m3u8', 'title_to_lecture_info', 'title_to_lecture_url',
+                            'title_to_m3u8s', 'player_type'}} dict
+    '''
+    
+    # note: every stage is wrapped in a span (see profiling.py) so --profile can tell where the time goes
+    
+    # do setup (one login / 2FA for all courses)
+    with span('setup_and_login'):
+        driver = setup_and_login()
+    
+    master_URL_to_lectures = {}
+    for master_URL in master_URLs:
+        with span('discover course', master_URL=master_URL):
+            # get sources
+            with span('get_player_page_source'):
+                player_page_source, player_type = get_player_page_source(driver, master_URL)
+            
+            # get video dict
+            with profile('extract_lecture_links'):
+                lecture_to_url = extract_lecture_links(player_page_source, player=player_type)
+            
+            # open all links (keep the driver alive for the next course)
+            with span('open_lecture_links', num_lectures=len(lecture_to_url)):
+                title_to_page_source = open_lecture_links(driver, lecture_to_url, player=player_type, quit_driver=False)
             
-            for ts_url in tqdm(ts_list, desc='downloading lecture'):
-                mp4.write(requests.get(ts_url).content)
+            # the driver is now on the player's domain, so cache its cookies too (see "fetch_lecture_m3u8s")
+            save_session(driver, merge=True)
+        
+        master_URL_to_lectures[master_URL] = (lecture_to_url, title_to_page_source, player_type)
+    
+    # quitting the driver is what (mostly) flushes the net log
+    with span('driver.quit'):
+        driver.quit()
+    
+    # extract data from network
+    # note: the log holds the m3u8s of every course, but get_title_to_m3u8s only picks up the ids it is looking for
+    with profile('extract_m3u8s_from_netlog'):
+        all_lecture_m3u8s = extract_m3u8s_from_netlog()
+    
+    master_URL_to_data = {}
+    for master_URL, (lecture_to_url, title_to_page_source, player_type) in master_URL_to_lectures.items():
+        # organize extracted data
+        with profile('get_title_to_m3u8s', master_URL=master_URL):
+            title_to_m3u8s = get_title_to_m3u8s(lecture_to_url, all_lecture_m3u8s, player=player_type)
+        
+        # find final download links (and how long / big each lecture is)
+        with span('get_title_to_download_links', master_URL=master_URL):
+            title_to_best_m3u8, title_to_lecture_info = get_title_to_download_links(title_to_m3u8s, player=player_type,
+                                                                                    return_info=True)
+        
+        # note: title_to_lecture_url and title_to_m3u8s are kept so expired links can be refreshed without the browser
+        master_URL_to_data[master_URL] = {'title_to_page_source': title_to_page_source,
+                                          'title_to_best_m3u8': title_to_best_m3u8,
+                                          'title_to_lecture_info': title_to_lecture_info,
+                                          'title_to_lecture_url': lecture_to_url,
+                                          'title_to_m3u8s': title_to_m3u8s,
+                                          'player_type': player_type}
+    
+    return master_URL_to_data
 
-                # break if over timeout_max
-                time_delta = time.time() - start_time
-                if time_delta > timeout_max:
-                    print('broke from loop after {} seconds'.format(time_delta))
-                    break
+
+def fetch_lecture_m3u8s(lecture_url, player):
+    '''
+    re-fetch the (master) m3u8 links of a single lecture over plain HTTP from the player's metadata API
+    
+    this uses the cached session (including the player cookies saved during discovery), so no browser is needed
+    '''
+    
+    session = get_canvas_session()
+    if session is None:
+        raise ConnectionError('there is no usable cached session to re-fetch lecture data with (run a discovery again)')
+    
+    # the lecture id is the same id used in "get_title_to_m3u8s"
+    lecture_id = lecture_url.split('id=')[1]
+    
+    with session:
+        if player == 'panopto':
+            r = session.post(PANOPTO_URL + '/Panopto/Pages/Viewer/DeliveryInfo.aspx',
+                             data={'deliveryId': lecture_id, 'responseType': 'json'})
+            r.raise_for_status()
+            
+            streams = r.json()['Delivery']['Streams']
+            return sort_m3u8s([stream['StreamUrl'] for stream in streams if '.m3u8' in (stream.get('StreamUrl') or '')])
+        
+        elif player == 'matterhorn':
+            r = session.get(MATTERHORN_URL + '/search/episode.json', params={'id': lecture_id})
+            r.raise_for_status()
+            
+            tracks = r.json()['search-results']['result']['mediapackage']['media']['track']
+            # note: a single track is not wrapped in a list
+            if isinstance(tracks, dict):
+                tracks = [tracks]
+            return sort_m3u8s([track['url'] for track in tracks if '.m3u8' in track.get('url', '')])
+
+
+def refresh_download_links(title, lecture, player):
+    '''
+    re-resolve the download links of a single lecture from its cached data (its entry in a course cache index, see cache.py)
+    
+    the cached m3u8s are resolved again first. if those have expired too, they are re-fetched with "fetch_lecture_m3u8s"
+    
+    return: (best_m3u8s, lecture_infos) for the lecture
+    '''
+    
+    # note: expired m3u8s come back as error pages, which "get_title_to_download_links" skips (so we get no links)
+    m3u8s = lecture['m3u8s']
+    title_to_best_m3u8, title_to_lecture_info = get_title_to_download_links({title: m3u8s}, player, return_info=True)
+    
+    if len(title_to_best_m3u8[title]) == 0:
+        lecture_url = lecture['lecture_url']
+        if lecture_url is None:
+            raise KeyError(f'the cache is too old to refresh "{title}". delete the course cache and run again')
+        
+        # keep the order of the cached m3u8s (caches written before m3u8s were sorted have the net log order)
+        m3u8s = sort_m3u8s(fetch_lecture_m3u8s(lecture_url, player), reference_m3u8s=lecture['m3u8s'])
+        title_to_best_m3u8, title_to_lecture_info = get_title_to_download_links({title: m3u8s}, player, return_info=True)
+    
+    if len(title_to_best_m3u8[title]) == 0:
+        raise ConnectionError(f'could not refresh the download links of "{title}"')
+    
+    return title_to_best_m3u8[title], title_to_lecture_info[title]
 
 
 #--------------------------------------------------------------------------------------------------------------
@@ -0,0 +1,283 @@
+import hashlib
+import json
+import os
+import queue
+import re
+import threading
+
+from .globals import S3_PART_SIZE, S3_MULTIPART_THRESHOLD
+
+
+def preallocate(f, size):
+    '''
+    reserve size bytes on disk for an open file (so concurrent downloads don't fragment each other)
+    '''
+    
+    f.flush()
+    
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+            return
+        except OSError:
+            # not every filesystem supports fallocate
+            pass
+    
+    # fall back to just growing the file
+    f.truncate(size)
+
+
+def readinto_full(raw, view):
+    '''
+    read from raw into view until view is full or raw is exhausted
+    
+    return: the number of bytes read
+    '''
+    
+    filled = 0
+    while filled < len(view):
+        n = raw.readinto(view[filled:])
+        if not n:
+            break
+        filled += n
+    
+    return filled
+
+
+class LectureChecksum:
+    '''
+    incrementally compute the md5, sha256 and expected S3 ETag of a file as it is written
+    '''
+    
+    def __init__(self, part_size=S3_PART_SIZE, multipart_threshold=S3_MULTIPART_THRESHOLD):
+        self.part_size = part_size
+        self.multipart_threshold = multipart_threshold
+        self.size = 0
+        
+        self.md5 = hashlib.md5()
+        self.sha256 = hashlib.sha256()
+        
+        # S3 multipart ETags are the md5 of the concatenated (binary) md5s of each part
+        self.part_digests = []
+        self.part_md5 = hashlib.md5()
+        self.part_filled = 0
+    
+    def update(self, data):
+        self.size += len(data)
+        self.md5.update(data)
+        self.sha256.update(data)
+        
+        # split data over part boundaries
+        data = memoryview(data)
+        while len(data) > 0:
+            take = min(self.part_size - self.part_filled, len(data))
+            self.part_md5.update(data[:take])
+            self.part_filled += take
+            data = data[take:]
+            
+            if self.part_filled == self.part_size:
+                self.part_digests.append(self.part_md5.digest())
+                self.part_md5 = hashlib.md5()
+                self.part_filled = 0
+    
+    def get_etag(self):
+        '''
+        return the ETag S3 will report after the file is uploaded with "put_multipart" using part_size
+        '''
+        
+        # small files are uploaded with a single PUT, so the ETag is just the md5
+        if self.size < self.multipart_threshold:
+            return self.md5.hexdigest()
+        
+        part_digests = list(self.part_digests)
+        if self.part_filled > 0:
+            part_digests.append(self.part_md5.digest())
+        
+        return hashlib.md5(b''.join(part_digests)).hexdigest() + '-' + str(len(part_digests))
+    
+    def to_dict(self):
+        return {'size': self.size,
+                'md5': self.md5.hexdigest(),
+                'sha256': self.sha256.hexdigest(),
+                'etag': self.get_etag(),
+                'part_size': self.part_size,
+                'multipart_threshold': self.multipart_threshold}
+
+
+def is_md5_etag(etag):
+    '''
+    check if an ETag is a (single or multipart) md5 ETag that "LectureChecksum.get_etag" can reproduce
+    
+    note: objects encrypted with SSE-KMS / SSE-C have ETags that are not an md5 of their data
+    '''
+    
+    return re.fullmatch(r'[0-9a-f]{32}(-[0-9]+)?', etag or '') is not None
+
+
+def get_checksum_path(path):
+    '''
+    return the path of the checksum sidecar for a file
+    '''
+    
+    return path + '.json'
+
+
+def save_checksum(path, checksum):
+    '''
+    write a checksum dict (from "LectureChecksum.to_dict") to the sidecar of path
+    '''
+    
+    with open(get_checksum_path(path), 'w') as f:
+        json.dump(checksum, f)
+
+
+def load_checksum(path, part_size=S3_PART_SIZE, multipart_threshold=S3_MULTIPART_THRESHOLD):
+    '''
+    return the checksum dict stored in the sidecar of path
+    
+    return: None if there is no sidecar, it was computed with a different multipart config, or it doesn't match the file
+    '''
+    
+    try:
+        with open(get_checksum_path(path), 'r') as f:
+            checksum = json.load(f)
+    except FileNotFoundError:
+        return None
+    
+    # a stale sidecar is as good as no sidecar
+    # note: sidecars written before the threshold was recorded always used the default
+    if checksum['part_size'] != part_size \
+            or checksum.get('multipart_threshold', S3_MULTIPART_THRESHOLD) != multipart_threshold \
+            or checksum['size'] != os.path.getsize(path):
+        return None
+    
+    return checksum
+
+
+def compute_checksum(path, part_size=S3_PART_SIZE, multipart_threshold=S3_MULTIPART_THRESHOLD, buffer_size=1048576):
+    '''
+    compute the checksum dict of an existing file (for files downloaded without a sidecar)
+    '''
+    
+    checksum = LectureChecksum(part_size, multipart_threshold)
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    
+    with open(path, 'rb') as f:
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            checksum.update(view[:n])
+    
+    return checksum.to_dict()
+
+
+class LectureWriter:
+    '''
+    write a file to disk from a dedicated thread
+    
+    data is read straight into a fixed pool of reusable buffers which are handed to the writer thread through a bounded
+    queue. this lets network reads and disk writes overlap without allocating a new bytes object for every chunk. the
+    writer thread also keeps a running checksum (see "LectureChecksum") so the file never has to be read back
+    '''
+    
+    def __init__(self, path, size_hint=None, buffer_size=1048576, num_buffers=8, part_size=S3_PART_SIZE,
+                 multipart_threshold=S3_MULTIPART_THRESHOLD):
+        '''
+        size_hint (int) : the expected final size of the file. the file is preallocated to this size and truncated to the
+                          number of bytes actually written on close
+        part_size, multipart_threshold (int) : the S3 multipart config used for the expected ETag
+        '''
+        
+        self.file = open(path, 'wb')
+        self.bytes_written = 0
+        self.error = None
+        self.checksum = LectureChecksum(part_size, multipart_threshold)
+        
+        if size_hint:
+            preallocate(self.file, size_hint)
+        
+        # buffers waiting to be filled (by the caller) and buffers waiting to be written (by the writer thread)
+        self.free_buffers = queue.Queue()
+        for _ in range(num_buffers):
+            self.free_buffers.put(bytearray(buffer_size))
+        self.filled_buffers = queue.Queue(maxsize=num_buffers)
+        
+        self.thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+    
+    def _write_loop(self):
+        while True:
+            item = self.filled_buffers.get()
+            
+            # None means we are closing
+            if item is None:
+                return
+            
+            buffer, length = item
+            
+            # after an error, keep recycling buffers so the reader never blocks (the error is raised on the next write)
+            if self.error is None:
+                try:
+                    data = memoryview(buffer)[:length]
+                    self.file.write(data)
+                    self.checksum.update(data)
+                except Exception as e:
+                    self.error = e
+            
+            self.free_buffers.put(buffer)
+    
+    def write_from(self, raw, limit=None):
+        '''
+        copy from a file-like object (anything with "readinto") until it is exhausted (or limit bytes have been copied)
+        
+        yield: the number of bytes copied for each buffer
+        '''
+        
+        copied = 0
+        while limit is None or copied < limit:
+            if self.error is not None:
+                raise self.error
+            
+            buffer = self.free_buffers.get()
+            view = memoryview(buffer)
+            if limit is not None:
+                view = view[:limit - copied]
+            
+            length = readinto_full(raw, view)
+            if length != 0:
+                self.filled_buffers.put((buffer, length))
+                self.bytes_written += length
+                copied += length
+                yield length
+            else:
+                self.free_buffers.put(buffer)
+            
+            # a partially filled buffer means raw is exhausted
+            if length < len(view):
+                break
+    
+    def close(self):
+        '''
+        wait for all pending writes, then trim the file to the number of bytes written
+        '''
+        
+        if self.file.closed:
+            return
+        
+        self.filled_buffers.put(None)
+        self.thread.join()
+        
+        try:
+            if self.error is not None:
+                raise self.error
+            self.file.truncate(self.bytes_written)
+        finally:
+            self.file.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
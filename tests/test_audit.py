@@ -0,0 +1,50 @@
+from final_project.audit import check_lecture, UnverifiableError, TS_PACKET_SIZE, TS_SYNC_BYTE
+from final_project.writer import LectureChecksum, save_checksum
+
+import pytest
+
+
+def write_ts(tmp_path, num_packets):
+    # whole, aligned TS packets (like a short stub of a lecture)
+    path = str(tmp_path / 'lecture.mp4')
+    with open(path, 'wb') as f:
+        f.write((bytes([TS_SYNC_BYTE]) + bytes(TS_PACKET_SIZE - 1)) * num_packets)
+    return path
+
+
+def test_sidecar(tmp_path):
+    path = write_ts(tmp_path, 100)
+    checksum = LectureChecksum(5*1048576, 8*1048576)
+    checksum.update(open(path, 'rb').read())
+    
+    save_checksum(path, dict(checksum.to_dict(), requests_done=3, requests_total=3))
+    assert check_lecture(path) is None
+    
+    save_checksum(path, dict(checksum.to_dict(), requests_done=1, requests_total=3))
+    assert 'stopped early' in check_lecture(path)
+
+
+def test_stub_without_sidecar(tmp_path):
+    # a valid container, but much shorter than its playlist
+    path = write_ts(tmp_path, 100)
+    
+    assert check_lecture(path, get_playlist_size=lambda: (100*TS_PACKET_SIZE, True)) is None
+    assert 'does not match the playlist' in check_lecture(path, get_playlist_size=lambda: (1000*TS_PACKET_SIZE, True))
+    # estimated playlist sizes only catch files that are much too small
+    assert check_lecture(path, get_playlist_size=lambda: (101*TS_PACKET_SIZE, False)) is None
+    assert 'of the size of the playlist' in check_lecture(path, get_playlist_size=lambda: (1000*TS_PACKET_SIZE, False))
+
+
+def test_unverifiable(tmp_path):
+    path = write_ts(tmp_path, 100)
+    
+    def get_playlist_size():
+        raise IOError('403 Forbidden')
+    
+    with pytest.raises(UnverifiableError):
+        check_lecture(path, get_playlist_size=get_playlist_size)
+    with pytest.raises(UnverifiableError):
+        check_lecture(path)
+    
+    # an estimate is still something to compare with
+    assert check_lecture(path, estimated_size=100*TS_PACKET_SIZE, get_playlist_size=get_playlist_size) is None
@@ -0,0 +1,19 @@
+from final_project.cli import parser, get_shard
+
+import pytest
+
+
+def parse_shard(shard):
+    return get_shard(parser.parse_args(['download', 'https://canvas.harvard.edu/courses/1111/external_tools/1', '--shard', shard]))
+
+
+def test_get_shard():
+    assert get_shard(parser.parse_args(['download', 'https://canvas.harvard.edu/courses/1111/external_tools/1'])) == (0, 1)
+    assert parse_shard('0/3') == (0, 3)
+    assert parse_shard('2/3') == (2, 3)
+
+
+@pytest.mark.parametrize('shard', ['3/3', '-1/3', '1', 'a/b', '1/0'])
+def test_invalid_shard(shard):
+    with pytest.raises(SystemExit):
+        parse_shard(shard)
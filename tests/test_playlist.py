@@ -0,0 +1,153 @@
+from final_project.globals import SMOKE_BYTES, SMOKE_SEGMENTS
+from final_project.scrape import parse_byterange, parse_media_playlist, get_download_requests, estimate_lecture_info, \
+    stream_byterange, MAX_COALESCED_REQUEST_SIZE
+from final_project.writer import LectureWriter
+
+import io
+
+import pytest
+
+PLAYLIST_URL = 'https://cdn.example.com/lecture/index.m3u8'
+
+
+def test_parse_byterange():
+    assert parse_byterange('100@20') == (20, 100)
+    # no offset means the range starts where the previous one ended
+    assert parse_byterange('100', previous_end=120) == (120, 100)
+    
+    with pytest.raises(ValueError):
+        parse_byterange('100')
+
+
+def test_offsetless_byterange():
+    playlist = '\n'.join(['#EXTM3U',
+                          '#EXTINF:2.0,',
+                          '#EXT-X-BYTERANGE:100@0',
+                          'video.ts',
+                          '#EXTINF:2.5,',
+                          '#EXT-X-BYTERANGE:200',
+                          'video.ts',
+                          '#EXTINF:3.0,',
+                          '#EXT-X-BYTERANGE:50',
+                          'video.ts',
+                          '#EXT-X-ENDLIST'])
+    
+    segments = parse_media_playlist(playlist, PLAYLIST_URL)
+    
+    assert [segment['byterange'] for segment in segments] == [(0, 100), (100, 200), (300, 50)]
+    assert [segment['duration'] for segment in segments] == [2.0, 2.5, 3.0]
+    assert all(segment['url'] == 'https://cdn.example.com/lecture/video.ts' for segment in segments)
+    
+    # every range touches the last one, so this is a single request
+    assert get_download_requests(segments) == [('https://cdn.example.com/lecture/video.ts', (0, 350))]
+
+
+def test_offsetless_byterange_of_a_different_file():
+    playlist = '\n'.join(['#EXT-X-BYTERANGE:100@0',
+                          'a.ts',
+                          '#EXT-X-BYTERANGE:100',
+                          'b.ts'])
+    
+    # the offset can only be implied by a sub-range of the same resource
+    with pytest.raises(ValueError):
+        parse_media_playlist(playlist, PLAYLIST_URL)
+
+
+def test_map_changes():
+    playlist = '\n'.join(['#EXT-X-MAP:URI="init0.mp4",BYTERANGE="720@0"',
+                          '#EXTINF:2.0,',
+                          'seg0.m4s',
+                          '#EXTINF:2.0,',
+                          'seg1.m4s',
+                          '#EXT-X-MAP:URI="init1.mp4"',
+                          '#EXTINF:2.0,',
+                          'seg2.m4s'])
+    
+    segments = parse_media_playlist(playlist, PLAYLIST_URL)
+    
+    assert segments[0]['init'] == {'url': 'https://cdn.example.com/lecture/init0.mp4', 'byterange': (0, 720)}
+    assert segments[1]['init'] == segments[0]['init']
+    assert segments[2]['init'] == {'url': 'https://cdn.example.com/lecture/init1.mp4', 'byterange': None}
+    
+    # each init section is requested once, right before the first segment that uses it
+    assert [url.rsplit('/', 1)[1] for url, _ in get_download_requests(segments)] == \
+        ['init0.mp4', 'seg0.m4s', 'seg1.m4s', 'init1.mp4', 'seg2.m4s']
+
+
+def test_merge_cap():
+    part = 6*1048576
+    segments = [{'url': 'https://cdn.example.com/video.mp4', 'byterange': (i * part, part), 'duration': 2.0, 'init': None}
+                for i in range(5)]
+    
+    download_requests = get_download_requests(segments)
+    
+    # two parts fit in one request (12MB), a third would not (18MB)
+    assert [byterange for _, byterange in download_requests] == [(0, 2 * part), (2 * part, 2 * part), (4 * part, part)]
+    assert all(byterange[1] <= MAX_COALESCED_REQUEST_SIZE for _, byterange in download_requests)
+
+
+def test_no_merge_across_gaps():
+    segments = [{'url': 'https://cdn.example.com/video.mp4', 'byterange': (0, 100), 'duration': 2.0, 'init': None},
+                {'url': 'https://cdn.example.com/video.mp4', 'byterange': (200, 100), 'duration': 2.0, 'init': None}]
+    
+    assert len(get_download_requests(segments)) == 2
+
+
+def test_estimate_smoke_size():
+    segments = [{'url': 'https://cdn.example.com/seg{}.ts'.format(i), 'byterange': None, 'duration': 10.0, 'init': None}
+                for i in range(100)]
+    
+    # a test run downloads SMOKE_SEGMENTS whole segments
+    info = estimate_lecture_info(segments, bandwidth=8000000)
+    assert info['size'] == 1000000000
+    assert info['smoke_size'] == SMOKE_SEGMENTS * 10000000
+    
+    # or the start of the file
+    info = estimate_lecture_info(segments, content_length=1000000000)
+    assert info['smoke_size'] == SMOKE_BYTES
+
+
+class FakeResponse:
+    '''
+    a streamed response whose body might be shorter than it claims (like a dropped connection)
+    '''
+    
+    def __init__(self, body, status_code=206, content_length=None):
+        self.raw = io.BytesIO(body)
+        self.status_code = status_code
+        self.headers = {'Content-Length': str(content_length)} if content_length is not None else {}
+    
+    def raise_for_status(self):
+        pass
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        pass
+
+
+class FakeSession:
+    def __init__(self, response):
+        self.response = response
+    
+    def get(self, url, headers=None, stream=False):
+        return self.response
+
+
+@pytest.mark.parametrize('response, byterange', [
+    # a byte range that ends early
+    (FakeResponse(b'x' * 50), (0, 100)),
+    # a whole file shorter than its Content-Length
+    (FakeResponse(b'x' * 50, status_code=200, content_length=100), None),
+])
+def test_truncated_body(tmp_path, response, byterange):
+    with LectureWriter(str(tmp_path / 'lecture.mp4')) as writer:
+        with pytest.raises(IOError):
+            list(stream_byterange(FakeSession(response), 'https://cdn.example.com/video.mp4', byterange, writer))
+
+
+def test_whole_body(tmp_path):
+    response = FakeResponse(b'x' * 100, status_code=200, content_length=100)
+    with LectureWriter(str(tmp_path / 'lecture.mp4')) as writer:
+        assert sum(stream_byterange(FakeSession(response), 'https://cdn.example.com/video.mp4', None, writer)) == 100
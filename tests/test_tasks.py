@@ -0,0 +1,82 @@
+from final_project import luigi_tasks
+from final_project.luigi_tasks import DownloadAllLectures, UploadAllLectures, is_upload_verified, is_in_shard
+
+import pytest
+
+COURSE_URLS = ['https://canvas.harvard.edu/courses/1111/external_tools/1', 'https://canvas.harvard.edu/courses/2222/external_tools/1']
+
+
+def get_index(num_lectures=2, num_perspectives=2):
+    title_to_lecture = {'Lecture {}'.format(i): {'best_m3u8s': ['https://cdn.example.com/{}/{}.m3u8'.format(i, j)
+                                                               for j in range(num_perspectives)],
+                                                 'lecture_infos': []}
+                        for i in range(num_lectures)}
+    return {'player_type': 'panopto', 'title_to_lecture': title_to_lecture}
+
+
+@pytest.mark.parametrize('Wrapper', [DownloadAllLectures, UploadAllLectures])
+def test_courses_with_the_same_titles(monkeypatch, Wrapper):
+    monkeypatch.setattr(luigi_tasks, 'S3_ROOT', 's3://bucket/lectures')
+    wrapper = Wrapper(master_URLs=COURSE_URLS, process_slides=True, is_test_run=False)
+    
+    lecture_tasks = []
+    slide_tasks = []
+    for master_URL in COURSE_URLS:
+        course_lecture_tasks, course_slide_tasks = wrapper.get_course_tasks(master_URL, get_index())
+        lecture_tasks += course_lecture_tasks
+        slide_tasks += course_slide_tasks
+    
+    # both courses have a "Lecture 0" and "Lecture 1", but every task (and file) is its own
+    assert len({task.task_id for task in lecture_tasks + slide_tasks}) == 4*2 + 2*2
+    assert len({task.output().path for task in lecture_tasks}) == 4*2
+    
+    download_slide_tasks = [getattr(task, 'get_download_task', lambda: task)() for task in slide_tasks]
+    assert len({task.get_folder_path() for task in download_slide_tasks}) == 2*2
+
+
+CHECKSUM = {'size': 1048576, 'etag': 'c35cc7d8d91728a0cb052831bc4ef372'}
+
+
+@pytest.mark.parametrize('head, verified', [
+    ({'ETag': '"c35cc7d8d91728a0cb052831bc4ef372"', 'ContentLength': 1048576}, True),
+    ({'ETag': '"00000000000000000000000000000000"', 'ContentLength': 1048576}, False),
+    # SSE-S3 ETags are still md5s
+    ({'ETag': '"c35cc7d8d91728a0cb052831bc4ef372"', 'ContentLength': 1048576, 'ServerSideEncryption': 'AES256'}, True),
+    # SSE-KMS / SSE-C ETags never match, so only the size is compared
+    ({'ETag': '"4fd1a2c3b0e9d8f7a6b5c4d3e2f1a0b9"', 'ContentLength': 1048576, 'ServerSideEncryption': 'aws:kms'}, True),
+    ({'ETag': '"4fd1a2c3b0e9d8f7a6b5c4d3e2f1a0b9"', 'ContentLength': 1000, 'ServerSideEncryption': 'aws:kms'}, False),
+    ({'ETag': '"not-an-md5"', 'ContentLength': 1048576, 'SSECustomerAlgorithm': 'AES256'}, True),
+])
+def test_is_upload_verified(head, verified):
+    assert is_upload_verified(head, CHECKSUM) is verified
+
+
+@pytest.mark.parametrize('num_shards', [1, 2, 3, 7])
+def test_every_task_in_one_shard(num_shards):
+    wrapper = DownloadAllLectures(master_URLs=COURSE_URLS, process_slides=True, is_test_run=False)
+    tasks = []
+    for master_URL in COURSE_URLS:
+        lecture_tasks, slide_tasks = wrapper.get_course_tasks(master_URL, get_index(num_lectures=20))
+        tasks += lecture_tasks + slide_tasks
+    
+    for task in tasks:
+        assert sum(is_in_shard(task, shard_index, num_shards) for shard_index in range(num_shards)) == 1
+    
+    # every shard gets some of the work
+    for shard_index in range(num_shards):
+        assert any(is_in_shard(task, shard_index, num_shards) for task in tasks)
+
+
+def test_shard_ignores_the_url():
+    # refreshing an expired link changes the url, but must not move the lecture to another shard
+    index = get_index()
+    wrapper = DownloadAllLectures(master_URLs=COURSE_URLS, process_slides=False, is_test_run=False)
+    tasks, _ = wrapper.get_course_tasks(COURSE_URLS[0], index)
+    
+    for lecture in index['title_to_lecture'].values():
+        lecture['best_m3u8s'] = [url + '?refreshed' for url in lecture['best_m3u8s']]
+    refreshed_tasks, _ = wrapper.get_course_tasks(COURSE_URLS[0], index)
+    
+    for task, refreshed_task in zip(tasks, refreshed_tasks):
+        assert task.url != refreshed_task.url
+        assert [is_in_shard(task, i, 5) for i in range(5)] == [is_in_shard(refreshed_task, i, 5) for i in range(5)]
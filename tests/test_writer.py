@@ -0,0 +1,71 @@
+from final_project.globals import SMOKE_MULTIPART_THRESHOLD
+from final_project.writer import LectureChecksum, LectureWriter, is_md5_etag
+
+import io
+
+import pytest
+
+MB = 1048576
+
+# boto3's defaults (8MB multipart threshold) with the smallest part size S3 allows
+PART_SIZE = 5*MB
+MULTIPART_THRESHOLD = 8*MB
+
+
+def get_data(size):
+    return (bytes(range(256)) * (size // 256 + 1))[:size]
+
+
+# ETags S3 reports for get_data(size) uploaded with "upload_file" using PART_SIZE / MULTIPART_THRESHOLD
+@pytest.mark.parametrize('size, etag', [
+    # below the threshold: a single PUT, so just the md5
+    (1*MB, 'c35cc7d8d91728a0cb052831bc4ef372'),
+    # exactly the threshold: multipart (5MB + 3MB)
+    (8*MB, '6f5ec6f8536f64075bdb90edc5cb9f96-2'),
+    # an exact multiple of the part size
+    (10*MB, '0f19691038865e87d093ed895276e9de-2'),
+    # a trailing partial part
+    (11*MB + 123, 'a3793b934c69bf6075985cd13e96b0f2-3'),
+])
+def test_etag(size, etag):
+    data = get_data(size)
+    
+    checksum = LectureChecksum(PART_SIZE, MULTIPART_THRESHOLD)
+    # feed odd sized chunks so updates straddle part boundaries
+    for start in range(0, size, 1000003):
+        checksum.update(data[start:start + 1000003])
+    
+    assert checksum.get_etag() == etag
+    assert checksum.to_dict()['size'] == size
+
+
+def test_etag_always_multipart():
+    # smoke runs upload everything as multipart
+    checksum = LectureChecksum(PART_SIZE, SMOKE_MULTIPART_THRESHOLD)
+    checksum.update(get_data(3*MB))
+    
+    assert checksum.get_etag() == 'fbf60193f8c8206a021e35230061d81b-1'
+
+
+def test_is_md5_etag():
+    assert is_md5_etag('c35cc7d8d91728a0cb052831bc4ef372')
+    assert is_md5_etag('a3793b934c69bf6075985cd13e96b0f2-3')
+    assert not is_md5_etag(None)
+    assert not is_md5_etag('not-an-etag')
+
+
+def test_writer(tmp_path):
+    data = get_data(3*MB + 17)
+    path = str(tmp_path / 'lecture.mp4')
+    
+    # a size hint that is too big is trimmed on close
+    with LectureWriter(path, size_hint=4*MB, buffer_size=65536, num_buffers=4, part_size=PART_SIZE,
+                       multipart_threshold=MULTIPART_THRESHOLD) as writer:
+        assert sum(writer.write_from(io.BytesIO(data))) == len(data)
+    
+    with open(path, 'rb') as f:
+        assert f.read() == data
+    
+    expected = LectureChecksum(PART_SIZE, MULTIPART_THRESHOLD)
+    expected.update(data)
+    assert writer.checksum.to_dict() == expected.to_dict()